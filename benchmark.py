@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import numpy as np
+from time import monotonic
+from datetime import datetime
+from itertools import product
+from loguru import logger
+from synthetic import write_synthetic_day
+from session import session_timeline, LUNCH
+from tape import load_day_tape
+from features import build_features
+from simulate import simulate, session_bounds, connect
+
+# peak memory comes from resource where it exists (Linux, macOS) and from
+# psutil, if installed, on Windows; without either it is reported as n/a
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BENCH_SPACE = [
+    [1.0, 1.25, 1.5, 1.75, 2.0],
+    [5, 7, 9, 11],
+    [30, 65, 120],
+    [78],
+    [0.007, 0.02],
+    [300],
+    [3, 5],
+    [1, 2],
+    [2, 5],
+    [3, 2002]
+]
+
+# n combinations drawn from BENCH_SPACE in a fixed order; beyond the size of the
+# grid combinations repeat, which costs the simulator the same as new ones
+def bench_combinations(n_combinations, seed=0):
+    grid = list(product(*BENCH_SPACE))
+    rng = np.random.default_rng(seed)
+    if n_combinations <= len(grid):
+        picks = rng.permutation(len(grid))[:n_combinations]
+    else:
+        picks = rng.integers(0, len(grid), n_combinations)
+    return [grid[i] for i in picks.tolist()]
+
+# PhaseTimer phases of the replay, in loop order, under the names the report uses;
+# price lookups happen inside execute_trades and are part of its time
+REPLAY_PHASES = [
+    ('set_metrics', 'tick'),
+    ('update_trade_tickers', 'trend'),
+    ('get_trade_tickers', 'candidates'),
+    ('stops', 'stops'),
+    ('execute_trades', 'trades'),
+    ('price_lookup', 'price_lookups'),
+    ('show_estimated_profit', 'mark_to_market')
+]
+
+def peak_rss_mb(children=False):
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+        # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+        return usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    if psutil is not None and not children:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / (1024 * 1024)
+    return None
+
+def mode_peak_rss_mb(proc_mode):
+    own = peak_rss_mb()
+    if not proc_mode:
+        return own
+    children = peak_rss_mb(children=True)
+    return None if own is None or children is None else max(own, children)
+
+# per-phase replay totals from the timing report simulate() writes for the day
+def replay_phases(day):
+    with open(os.path.join('log', f"timing_{day.strftime('%Y%m%d')}.json"), 'r') as file:
+        phases = json.load(file)['phases']
+    return {label: phases[name]['total'] for name, label in REPLAY_PHASES if name in phases}
+
+def run_mode(all_combinations, day, interval, proc_mode, timing=True):
+    phases = {}
+    started = monotonic()
+    tape = load_day_tape(connect, day)
+    phases['load'] = monotonic() - started
+
+    started = monotonic()
+    build_features(tape)
+    phases['features'] = monotonic() - started
+
+    start_time, end_time = session_bounds(day.year, day.month, day.day)
+    n_ticks = sum(1 for segment, row, current_time in session_timeline(tape, start_time, end_time, interval) if segment != LUNCH)
+
+    started = monotonic()
+    simulate(all_combinations, False, proc_mode, day.year, day.month, day.day, interval, progress=False, timing=timing)
+    seconds = monotonic() - started
+    # simulate() loads the tape and builds features itself as well
+    phases['replay'] = max(seconds - phases['load'] - phases['features'], 0)
+
+    n_combinations = len(all_combinations)
+    return {
+        'mode': 'processes' if proc_mode else 'serial',
+        'n_combinations': n_combinations,
+        'n_ticks': n_ticks,
+        'seconds': seconds,
+        'ticks_per_sec': n_ticks / seconds,
+        'combination_ticks_per_sec': n_combinations * n_ticks / seconds,
+        'peak_rss_mb': mode_peak_rss_mb(proc_mode),
+        'phases': phases,
+        'replay_phases': replay_phases(day) if timing else {}
+    }
+
+# Runs simulate() on a synthetic day in a scratch directory, so neither the
+# tape cache nor checkpoints of real runs are touched and no database is needed.
+# With timing the replay is also broken down by phase, at the cost of the
+# PhaseTimer's own overhead in the measured time.
+def run_benchmark(n_tickers=150, n_ticks=2656, n_combinations=64, seed=0, interval=8, modes=('serial', 'processes'),
+                  day=datetime(2024, 10, 17), json_path=None, timing=True):
+    all_combinations = bench_combinations(n_combinations, seed)
+    max_n_days = max(combination[3] for combination in all_combinations)
+
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        os.chdir(work_dir)
+        started = monotonic()
+        write_synthetic_day(day, max_n_days, seed=seed, n_tickers=n_tickers, n_ticks=n_ticks)
+        generate = monotonic() - started
+
+        reports = []
+        for mode in modes:
+            report = run_mode(all_combinations, day, interval, mode == 'processes', timing)
+            report['phases'] = {'generate': generate, **report['phases']}
+            reports.append(report)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for report in reports:
+        phases = ', '.join(f"{name}: {seconds:.2f}s" for name, seconds in report['phases'].items())
+        peak_rss = f"{report['peak_rss_mb']:,.0f} MB" if report['peak_rss_mb'] is not None else 'n/a'
+        logger.info(f"{report['mode']}: {report['n_combinations']} combinations x {report['n_ticks']} ticks in {report['seconds']:.2f}s, "
+                    f"{report['ticks_per_sec']:,.1f} ticks/s, {report['combination_ticks_per_sec']:,.0f} combination-ticks/s, "
+                    f"peak rss {peak_rss} ({phases})")
+        if report['replay_phases']:
+            logger.info(f"{report['mode']} replay by phase, summed over shards: "
+                        f"{', '.join(f'{name}: {seconds:.2f}s' for name, seconds in report['replay_phases'].items())}")
+
+    if json_path:
+        with open(json_path, 'w') as file:
+            json.dump({'n_tickers': n_tickers, 'n_ticks': n_ticks, 'n_combinations': n_combinations, 'seed': seed, 'interval': interval,
+                       'timing': timing, 'reports': reports}, file, indent=2)
+    return reports
+
+if __name__ == "__main__":
+    n_tickers = 150
+    n_ticks = 2656
+    n_combinations = 64
+    seed = 0
+    modes = ('serial', 'processes')
+    json_path = 'benchmark.json'
+    timing = True
+
+    run_benchmark(n_tickers, n_ticks, n_combinations, seed, modes=modes, json_path=json_path, timing=timing)
@@ -0,0 +1,13 @@
+import numpy as np
+
+# Per-combination running peak of the equity and the deepest drawdown from it.
+# The time of the peak is real_max_profit's time, which the simulator already
+# keeps, so it is not tracked twice here.
+class EquityTracker:
+    def __init__(self, n_combinations):
+        self.peak = np.full(n_combinations, -np.inf)
+        self.max_drawdown = np.zeros(n_combinations)
+
+    def update(self, equity):
+        np.maximum(self.peak, equity, out=self.peak)
+        np.maximum(self.max_drawdown, self.peak - equity, out=self.max_drawdown)
@@ -0,0 +1,61 @@
+import numpy as np
+
+FEATURE_PRICES = ['current', 'long', 'short', 'volume']
+
+# price / volume bounds a ticker must pass to become a trade candidate
+MAX_PRICE = 15000
+MIN_VOLUME = 64000
+
+def ffill(values, valid):
+    rows = np.where(valid, np.arange(len(values))[:, None], -1)
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    has_value = rows >= 0
+    filled = np.take_along_axis(values, np.maximum(rows, 0), axis=0)
+    return filled, has_value
+
+# Row t is True for a ticker that passes the candidate price / volume check at
+# t or at any later row of the day. Once it turns False the ticker can never be
+# a candidate again; its trend state still matters while it is held or watched.
+def eligible_ahead(current, volume, max_price=MAX_PRICE, min_volume=MIN_VOLUME):
+    with np.errstate(invalid='ignore'):
+        eligible = (current < max_price) & (volume > min_volume)
+    return np.ascontiguousarray(np.logical_or.accumulate(eligible[::-1], axis=0)[::-1])
+
+# Same fallback chain the simulator used to walk through last_values on every
+# call: last good price, mid of last bid/ask, last price +-0.1%, sentinels.
+def build_features(tape):
+    present = np.asarray(tape.present)
+    columns = {name: np.asarray(column) for name, column in tape.columns.items()}
+
+    with np.errstate(invalid='ignore'):
+        current, has_current = ffill(columns['current_price'], present & (columns['current_price'] > 0.001))
+        bid, has_bid = ffill(columns['bid_price_1'], present & (columns['bid_price_1'] > 0.001))
+        ask, has_ask = ffill(columns['ask_price_10'], present & (columns['ask_price_10'] > 0.001))
+        volume, has_volume = ffill(columns['volume'], present & (columns['volume'] > 0))
+
+    current = np.where(has_current, current, np.where(has_bid & has_ask, (bid + ask) / 2, np.nan))
+    volume = np.where(has_volume, volume, 1000000000)
+    return {
+        'present': present,
+        'eligible': eligible_ahead(current, volume),
+        'ask_quantity_total': columns['ask_quantity_total'],
+        'bid_quantity_total': columns['bid_quantity_total'],
+        'current': current,
+        'long': np.where(has_ask, ask, np.where(has_current, current * 1.001, 1000000000)),
+        'short': np.where(has_bid, bid, np.where(has_current, current * 0.999, -1)),
+        'volume': volume
+    }
+
+def feature_tick(features, row):
+    return {name: column[row] for name, column in features.items()}
+
+def blank_tick(features):
+    tick = {name: np.full(column.shape[1], np.nan) for name, column in features.items()}
+    tick['present'] = np.zeros(features['present'].shape[1], dtype=bool)
+    tick['eligible'] = np.ones(features['eligible'].shape[1], dtype=bool)
+    return tick
+
+def tick_at(features, row, previous_tick):
+    if row is None:
+        return dict(previous_tick, present=np.zeros_like(previous_tick['present']))
+    return feature_tick(features, row)
@@ -0,0 +1,91 @@
+import os
+import queue
+import struct
+import threading
+import numpy as np
+from result_cache import param_hash
+
+ACTIONS = {'LONG': 0, 'SELL': 1, 'SHORT': 2, 'COVER': 3}
+
+# tick (epoch seconds), combination id, ticker, action, price, quantity, realized pnl
+RECORD = struct.Struct('<qqqBdqd')
+RECORD_DTYPE = np.dtype([('tick', '<i8'), ('combination_id', '<i8'), ('ticker_id', '<i8'), ('action', 'u1'),
+                         ('price', '<f8'), ('qty', '<i8'), ('pnl', '<f8')])
+
+# the first 8 bytes of the result cache's param_hash, so a record names its
+# combination the same way in every run, shard split and sweep
+def combination_id(combination):
+    return int.from_bytes(bytes.fromhex(param_hash(combination)[:16]), 'little', signed=True)
+
+# Fixed-size trade records, packed on the simulating thread and appended to the
+# file by a background writer in batch_size chunks. A fresh run starts the file
+# over; a run resumed from a checkpoint at resume_tick keeps the records up to
+# that tick and appends after them.
+class TradeJournal:
+    def __init__(self, path, resume_tick=None, batch_size=4096):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size * RECORD.size
+        self.buffer = bytearray()
+        self.queue = queue.SimpleQueue()
+        self.ids = {}
+        if resume_tick is not None:
+            trim_journal(path, resume_tick)
+        self.file = open(path, 'wb' if resume_tick is None else 'ab')
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def record(self, tick, combination, ticker_id, action, price, qty, pnl):
+        ident = self.ids.get(combination)
+        if ident is None:
+            ident = self.ids[combination] = combination_id(combination)
+        self.buffer += RECORD.pack(tick, ident, ticker_id, ACTIONS[action], price, qty, pnl)
+        if len(self.buffer) >= self.batch_size:
+            self.queue.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def write_loop(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, threading.Event):
+                self.file.flush()
+                chunk.set()
+                continue
+            self.file.write(chunk)
+
+    # called before a checkpoint, so every record up to it is on disk
+    def flush(self):
+        if self.buffer:
+            self.queue.put(bytes(self.buffer))
+            self.buffer = bytearray()
+        written = threading.Event()
+        self.queue.put(written)
+        written.wait()
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.buffer:
+            self.queue.put(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.queue.put(None)
+        self.writer.join()
+        self.file.close()
+        self.file = None
+
+# drops the records after tick, and a record cut short by a crash, so a resumed
+# run does not write the trades since the checkpoint twice
+def trim_journal(path, tick):
+    try:
+        n_records = os.path.getsize(path) // RECORD.size
+    except OSError:
+        return
+    records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=n_records) if n_records else np.empty(0, RECORD_DTYPE)
+    keep = int(np.searchsorted(records['tick'], tick, side='right'))
+    del records
+    os.truncate(path, keep * RECORD.size)
+
+def read_journal(path):
+    return np.fromfile(path, dtype=RECORD_DTYPE)
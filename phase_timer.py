@@ -0,0 +1,96 @@
+import numpy as np
+from time import perf_counter
+from contextlib import contextmanager, nullcontext
+
+# upper edges of the per-tick histogram buckets, in seconds
+HISTOGRAM_EDGES = [0.0001, 0.001, 0.01, 0.1, 1.0]
+
+# Wall time per phase and per tick. Phases add to the tick in progress and
+# end_tick() closes it; a phase that did not run in a tick counts as zero, so
+# every phase has one entry per tick and shards can be summed tick by tick.
+class PhaseTimer:
+    def __init__(self):
+        self.ticks = {}
+        self.calls = {}
+        self.current = {}
+        self.n_ticks = 0
+
+    def add(self, phase, seconds):
+        self.current[phase] = self.current.get(phase, 0.0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    @contextmanager
+    def phase(self, name):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - started)
+
+    def end_tick(self):
+        for phase in self.current.keys() - self.ticks.keys():
+            self.ticks[phase] = [0.0] * self.n_ticks
+        for phase, ticks in self.ticks.items():
+            ticks.append(self.current.get(phase, 0.0))
+        self.current = {}
+        self.n_ticks += 1
+
+    def summary(self):
+        summary = {}
+        for phase, ticks in self.ticks.items():
+            ticks = np.asarray(ticks)
+            p50, p90, p99 = np.percentile(ticks, [50, 90, 99]) if len(ticks) else (0.0, 0.0, 0.0)
+            summary[phase] = {
+                'calls': self.calls.get(phase, 0),
+                'total': float(ticks.sum()),
+                'mean': float(ticks.mean()) if len(ticks) else 0.0,
+                'p50': float(p50),
+                'p90': float(p90),
+                'p99': float(p99),
+                'max': float(ticks.max()) if len(ticks) else 0.0,
+                'histogram': np.bincount(np.searchsorted(HISTOGRAM_EDGES, ticks), minlength=len(HISTOGRAM_EDGES) + 1).tolist()
+            }
+        return summary
+
+# Stand-in for PhaseTimer when timing is off: every phase is the same shared
+# no-op context, so the untimed loop runs the same body at almost no cost.
+class NullTimer:
+    def __init__(self):
+        self.context = nullcontext()
+
+    def phase(self, name):
+        return self.context
+
+    def end_tick(self):
+        pass
+
+NULL_TIMER = NullTimer()
+
+# shards step through the same ticks, so their timings add up tick by tick
+def merge_timers(timers):
+    merged = PhaseTimer()
+    merged.n_ticks = max((timer.n_ticks for timer in timers), default=0)
+    for timer in timers:
+        for phase, ticks in timer.ticks.items():
+            total = merged.ticks.setdefault(phase, [0.0] * merged.n_ticks)
+            for i, seconds in enumerate(ticks):
+                total[i] += seconds
+        for phase, calls in timer.calls.items():
+            merged.calls[phase] = merged.calls.get(phase, 0) + calls
+    return merged
+
+# price_index stand-in for execute_trades that books the close lookups, which
+# used to be SQL queries, under their own phase
+class TimedPriceIndex:
+    def __init__(self, price_index, timer, name='price_lookup'):
+        self.price_index = price_index
+        self.timer = timer
+        self.name = name
+
+    def max_close(self, ticker_id, check_date, n_days):
+        with self.timer.phase(self.name):
+            return self.price_index.max_close(ticker_id, check_date, n_days)
+
+    def min_close(self, ticker_id, check_date, n_days):
+        with self.timer.phase(self.name):
+            return self.price_index.min_close(ticker_id, check_date, n_days)
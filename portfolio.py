@@ -0,0 +1,234 @@
+import numpy as np
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+def to_micros(current_time):
+    return (current_time - EPOCH) // ONE_MICROSECOND
+
+class Lot:
+    __slots__ = ('price', 'qty', 'margin', 'row')
+
+    def __init__(self, price, qty, margin):
+        self.price = price
+        self.qty = qty
+        self.margin = margin
+        self.row = -1
+
+class Position:
+    __slots__ = ('ticker_id', 'pos_type', 'prices', 'max_price', 'min_price', 'min_from_max_price', 'max_from_min_price',
+                 'down_step', 'down_from_max_step', 'down_from_min_step', 'up_step', 'time', 'seq', 'closed', 'row')
+
+    def __init__(self, ticker_id, pos_type, lot, current_time):
+        self.ticker_id = ticker_id
+        self.pos_type = pos_type
+        self.prices = [lot]
+        self.max_price = lot.price
+        self.min_price = lot.price
+        self.min_from_max_price = lot.price
+        self.max_from_min_price = lot.price
+        self.down_step = 0
+        self.down_from_max_step = 0
+        self.down_from_min_step = 0
+        self.up_step = 0
+        self.time = current_time
+        self.seq = 0
+        self.closed = False
+        self.row = -1
+
+POSITION_FIELDS = {
+    'cnt': np.int64, 'col': np.int64, 'seq': np.int64, 'is_long': bool, 'alive': bool,
+    'min_price': np.float64, 'max_price': np.float64, 'from_price': np.float64,
+    'down_step': np.float64, 'up_step': np.float64, 'down_from_step': np.float64, 'time': np.int64
+}
+LOT_FIELDS = {'owner': np.int64, 'seq': np.int64, 'price': np.float64, 'qty': np.float64, 'margin': bool, 'alive': bool}
+
+# Open positions and lots of every combination of a simulator as flat arrays,
+# one row per position / lot. The portfolios keep it current as lots are added,
+# reduced and closed, so the batched stop engine and the mark-to-market read
+# whole columns instead of walking Position and Lot objects every tick. Rows of
+# closed positions and emptied lots are reused. The stop state columns mirror
+# the Position attributes for the batched engine, which writes both.
+class PositionBook:
+    def __init__(self, ticker_index, capacity=64):
+        self.ticker_index = ticker_index
+        self.positions = [None] * capacity
+        self.lots = [None] * capacity
+        self.pos = {name: np.zeros(capacity, dtype=kind) for name, kind in POSITION_FIELDS.items()}
+        self.lot = {name: np.zeros(capacity, dtype=kind) for name, kind in LOT_FIELDS.items()}
+        self.free_positions = []
+        self.free_lots = []
+        self.n_positions = 0
+        self.n_lots = 0
+        self.n_lots_added = 0
+
+    def grow(self, objects, fields):
+        capacity = len(objects)
+        objects.extend([None] * capacity)
+        for name, values in fields.items():
+            fields[name] = np.concatenate([values, np.zeros_like(values)])
+
+    def add_position(self, cnt, position):
+        if self.free_positions:
+            row = self.free_positions.pop()
+        else:
+            if self.n_positions == len(self.positions):
+                self.grow(self.positions, self.pos)
+            row = self.n_positions
+            self.n_positions += 1
+        position.row = row
+        self.positions[row] = position
+        is_long = position.pos_type == 'LONG'
+        pos = self.pos
+        pos['cnt'][row] = cnt
+        pos['col'][row] = self.ticker_index[position.ticker_id]
+        pos['seq'][row] = position.seq
+        pos['is_long'][row] = is_long
+        pos['alive'][row] = True
+        self.store_state(position)
+        for lot in position.prices:
+            self.add_lot(position, lot)
+
+    def store_state(self, position):
+        row = position.row
+        pos = self.pos
+        is_long = position.pos_type == 'LONG'
+        pos['min_price'][row] = position.min_price
+        pos['max_price'][row] = position.max_price
+        pos['from_price'][row] = position.min_from_max_price if is_long else position.max_from_min_price
+        pos['down_step'][row] = position.down_step
+        pos['up_step'][row] = position.up_step
+        pos['down_from_step'][row] = position.down_from_max_step if is_long else position.down_from_min_step
+        pos['time'][row] = to_micros(position.time)
+
+    def remove_position(self, position):
+        row = position.row
+        self.pos['alive'][row] = False
+        self.positions[row] = None
+        self.free_positions.append(row)
+        position.row = -1
+
+    def add_lot(self, position, lot):
+        if self.free_lots:
+            row = self.free_lots.pop()
+        else:
+            if self.n_lots == len(self.lots):
+                self.grow(self.lots, self.lot)
+            row = self.n_lots
+            self.n_lots += 1
+        lot.row = row
+        self.lots[row] = lot
+        fields = self.lot
+        fields['owner'][row] = position.row
+        fields['seq'][row] = self.n_lots_added
+        fields['price'][row] = lot.price
+        fields['qty'][row] = lot.qty
+        fields['margin'][row] = lot.margin
+        fields['alive'][row] = True
+        self.n_lots_added += 1
+
+    def update_lot(self, lot):
+        row = lot.row
+        self.lot['qty'][row] = lot.qty
+        if lot.qty == 0:
+            self.lot['alive'][row] = False
+            self.lots[row] = None
+            self.free_lots.append(row)
+            lot.row = -1
+
+    # live lots in portfolio order: by combination, position opening order and
+    # then lot order within the position, which is the order they were added
+    def live_lots(self):
+        rows = np.flatnonzero(self.lot['alive'][:self.n_lots])
+        owners = self.lot['owner'][rows]
+        order = np.lexsort((self.lot['seq'][rows], self.pos['seq'][owners], self.pos['cnt'][owners]))
+        return rows[order]
+
+# Open positions keyed by (ticker_id, pos_type). The dict keeps opening order,
+# which is the order the old pfl list had, and closes in O(1). Margin notional
+# and non-margin quantity per ticker are kept up to date as lots change, so
+# margin checks do not walk the lots.
+class Portfolio:
+    def __init__(self, book=None, cnt=None):
+        self.book = book
+        self.cnt = cnt
+        self.positions = {}
+        self.n_opened = 0
+        self.margin_notional = 0
+        self.margin_lots = 0
+        self.free_qty = {}
+
+    def __iter__(self):
+        return iter(self.positions.values())
+
+    def __len__(self):
+        return len(self.positions)
+
+    def get(self, ticker_id, pos_type):
+        return self.positions.get((ticker_id, pos_type))
+
+    def first(self, ticker_id):
+        long_pos = self.positions.get((ticker_id, 'LONG'))
+        short_pos = self.positions.get((ticker_id, 'SHORT'))
+        if long_pos is None or short_pos is None:
+            return long_pos or short_pos
+        return long_pos if long_pos.seq < short_pos.seq else short_pos
+
+    def holds(self, ticker_id):
+        return (ticker_id, 'LONG') in self.positions or (ticker_id, 'SHORT') in self.positions
+
+    def add(self, position):
+        position.seq = self.n_opened
+        self.n_opened += 1
+        self.positions[(position.ticker_id, position.pos_type)] = position
+        for lot in position.prices:
+            self.count_lot(position.ticker_id, lot, lot.qty)
+        if self.book is not None:
+            self.book.add_position(self.cnt, position)
+
+    def add_lot(self, position, lot):
+        position.prices.append(lot)
+        self.count_lot(position.ticker_id, lot, lot.qty)
+        if self.book is not None:
+            self.book.add_lot(position, lot)
+
+    def reduce_lot(self, position, lot, qty):
+        lot.qty -= qty
+        self.count_lot(position.ticker_id, lot, -qty)
+        if self.book is not None:
+            self.book.update_lot(lot)
+
+    def count_lot(self, ticker_id, lot, qty):
+        if lot.margin:
+            if qty > 0 and lot.qty == qty:
+                self.margin_lots += 1
+            elif qty < 0 and lot.qty == 0:
+                self.margin_lots -= 1
+            # reset once flat so rounding cannot build up over the day
+            self.margin_notional = self.margin_notional + qty * lot.price if self.margin_lots else 0
+        else:
+            free_qty = self.free_qty.get(ticker_id, 0) + qty
+            if free_qty:
+                self.free_qty[ticker_id] = free_qty
+            else:
+                del self.free_qty[ticker_id]
+
+    def remove(self, position):
+        position.closed = True
+        del self.positions[(position.ticker_id, position.pos_type)]
+        if self.book is not None:
+            self.book.remove_position(position)
+
+    # The stop-loss pass used to iterate the pfl list while closing positions
+    # out of it, so the position after a closed one was not visited that tick.
+    # Only the visited position can close during its own pass, so skipping one
+    # entry after it closes reproduces that walk on a snapshot.
+    def scan(self):
+        skip = False
+        for position in list(self.positions.values()):
+            if skip:
+                skip = False
+                continue
+            yield position
+            skip = position.closed
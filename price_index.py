@@ -0,0 +1,110 @@
+import os
+import numpy as np
+from datetime import datetime
+from tape import TAPE_CACHE_DIR, write_cache, read_cache
+
+PRICE_INDEX_SCHEMA_VERSION = 1
+
+def date_epoch(check_date):
+    return int((datetime(check_date.year, check_date.month, check_date.day) - datetime(1970, 1, 1)).total_seconds())
+
+class HighLowIndex:
+    def __init__(self, ticker_ids, dates, closes):
+        self.ticker_ids = ticker_ids
+        self.dates = dates
+        self.closes = closes
+        index_ticker_ids, self.ticker_cols = np.unique(ticker_ids, return_inverse=True)
+        self.ticker_index = {ticker_id: col for col, ticker_id in enumerate(index_ticker_ids.tolist())}
+        self.windows = {}
+
+    def window(self, check_date, n_days):
+        key = (check_date, n_days)
+        if key not in self.windows:
+            end = date_epoch(check_date)
+            start = end - n_days * 86400
+            in_window = (self.dates >= start) & (self.dates <= end)
+            cols = self.ticker_cols[in_window]
+            closes = self.closes[in_window]
+
+            max_close = np.full(len(self.ticker_index), np.nan)
+            min_close = np.full(len(self.ticker_index), np.nan)
+            np.fmax.at(max_close, cols, closes)
+            np.fmin.at(min_close, cols, closes)
+            self.windows[key] = (max_close.tolist(), min_close.tolist())
+        return self.windows[key]
+
+    def lookup(self, ticker_id, check_date, n_days, side):
+        col = self.ticker_index.get(ticker_id)
+        if col is None:
+            return None
+        value = self.window(check_date, n_days)[side][col]
+        return None if value != value else value
+
+    def max_close(self, ticker_id, check_date, n_days):
+        return self.lookup(ticker_id, check_date, n_days, 0)
+
+    def min_close(self, ticker_id, check_date, n_days):
+        return self.lookup(ticker_id, check_date, n_days, 1)
+
+def fetch_high_low_index(conn, day, max_n_days):
+    query = """
+    SELECT
+        ticker_id, extract(epoch FROM "date"::timestamp)::bigint, "Close"
+    FROM public.historical_data
+    WHERE
+        date >= %s::timestamp - INTERVAL '1 day' * %s
+        AND date <= %s::timestamp
+    ORDER BY ticker_id, date;
+    """
+    check_date = day.strftime('%Y-%m-%d')
+    with conn.cursor() as cursor:
+        cursor.execute(query, (check_date, max_n_days, check_date))
+        rows = cursor.fetchall()
+
+    ticker_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    dates = np.array([row[1] for row in rows], dtype=np.int64)
+    closes = np.array([np.nan if row[2] is None else float(row[2]) for row in rows], dtype=np.float64)
+    return HighLowIndex(ticker_ids, dates, closes)
+
+def fetch_high_low_stamp(conn, day, max_n_days):
+    query = """
+    SELECT count(*), extract(epoch FROM max(date)::timestamp)::bigint
+    FROM public.historical_data
+    WHERE
+        date >= %s::timestamp - INTERVAL '1 day' * %s
+        AND date <= %s::timestamp;
+    """
+    check_date = day.strftime('%Y-%m-%d')
+    with conn.cursor() as cursor:
+        cursor.execute(query, (check_date, max_n_days, check_date))
+        row_count, max_date = cursor.fetchone()
+    return {'row_count': row_count, 'max_date': max_date}
+
+def high_low_cache_path(day, max_n_days, cache_dir=TAPE_CACHE_DIR):
+    return os.path.join(cache_dir, f"high_low_{day.strftime('%Y%m%d')}_{max_n_days}_v{PRICE_INDEX_SCHEMA_VERSION}")
+
+def load_high_low_index(connect, day, max_n_days, cache_dir=TAPE_CACHE_DIR, verify=False):
+    path = high_low_cache_path(day, max_n_days, cache_dir)
+    names = ['ticker_ids', 'dates', 'closes']
+    conn = None
+    try:
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            arrays, meta = read_cache(path, names)
+            if meta.get('schema_version') == PRICE_INDEX_SCHEMA_VERSION:
+                if not verify:
+                    return HighLowIndex(*(np.asarray(arrays[name]) for name in names))
+                conn = connect()
+                if fetch_high_low_stamp(conn, day, max_n_days) == meta['stamp']:
+                    return HighLowIndex(*(np.asarray(arrays[name]) for name in names))
+
+        conn = conn or connect()
+        stamp = fetch_high_low_stamp(conn, day, max_n_days)
+        index = fetch_high_low_index(conn, day, max_n_days)
+    finally:
+        if conn is not None:
+            conn.close()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    arrays = {'ticker_ids': index.ticker_ids, 'dates': index.dates, 'closes': index.closes}
+    write_cache(path, arrays, {'schema_version': PRICE_INDEX_SCHEMA_VERSION, 'stamp': stamp})
+    return index
@@ -0,0 +1,91 @@
+import os
+import json
+import sqlite3
+import hashlib
+from datetime import datetime
+from tape import TAPE_CACHE_DIR, tape_cache_path
+
+RESULT_CACHE_PATH = os.path.join(TAPE_CACHE_DIR, 'results.sqlite3')
+
+# everything a day's result depends on besides the parameters and the tape
+CODE_FILES = ['simulate.py', 'simulator.py', 'trend.py', 'features.py', 'portfolio.py', 'stops.py', 'equity.py', 'tape.py', 'price_index.py', 'session.py']
+
+def param_hash(combination):
+    return hashlib.sha1(json.dumps(list(combination)).encode()).hexdigest()
+
+def code_hash():
+    digest = hashlib.sha1()
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in CODE_FILES:
+        with open(os.path.join(base_dir, name), 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def tape_stamp(day, cache_dir=TAPE_CACHE_DIR):
+    try:
+        with open(os.path.join(tape_cache_path(day, cache_dir), 'meta.json'), 'r') as file:
+            return json.load(file).get('stamp')
+    except (OSError, ValueError):
+        return None
+
+class ResultCache:
+    def __init__(self, path=RESULT_CACHE_PATH, config=None):
+        self.path = path
+        self.code_version = hashlib.sha1(json.dumps([code_hash(), config], sort_keys=True, default=str).encode()).hexdigest()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS results (
+            day TEXT, param_hash TEXT, version TEXT, combination TEXT,
+            balance REAL, real_profit REAL, real_max_profit REAL, real_max_profit_time TEXT,
+            stop INTEGER, max_drawdown REAL, transactions TEXT,
+            PRIMARY KEY (day, param_hash, version)
+        )
+        """)
+        self.conn.commit()
+
+    def version(self, day):
+        stamp = tape_stamp(day)
+        return hashlib.sha1(json.dumps([self.code_version, stamp], sort_keys=True).encode()).hexdigest()
+
+    def lookup(self, day, all_combinations):
+        rows = self.conn.execute(
+            'SELECT param_hash, balance, real_profit, real_max_profit, real_max_profit_time, stop, max_drawdown, transactions '
+            'FROM results WHERE day = ? AND version = ?',
+            (day.strftime('%Y-%m-%d'), self.version(day))
+        ).fetchall()
+        by_hash = {row[0]: row[1:] for row in rows}
+
+        cached = {}
+        for combination in all_combinations:
+            row = by_hash.get(param_hash(combination))
+            if row is None:
+                continue
+            balance, real_profit, real_max_profit, real_max_profit_time, stop, max_drawdown, transactions = row
+            cached[tuple(combination)] = {
+                'combination': tuple(combination),
+                'balance': balance,
+                'real_profit': real_profit,
+                'real_max_profit': real_max_profit,
+                'real_max_profit_time': datetime.fromisoformat(real_max_profit_time) if real_max_profit_time else None,
+                'stop': bool(stop),
+                'max_drawdown': max_drawdown,
+                'transactions': json.loads(transactions)
+            }
+        return cached
+
+    def store(self, day, results):
+        version = self.version(day)
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(day.strftime('%Y-%m-%d'), param_hash(result['combination']), version, json.dumps(list(result['combination'])),
+              result['balance'], result['real_profit'], result['real_max_profit'],
+              result['real_max_profit_time'].isoformat() if result['real_max_profit_time'] else None,
+              int(result['stop']), result['max_drawdown'], json.dumps(result['transactions']))
+             for result in results]
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,104 @@
+import os
+import heapq
+import sqlite3
+from datetime import datetime
+
+RESULTS_LOG_PATH = os.path.join('results', 'results.sqlite3')
+
+PARAM_COLUMNS = [
+    ('root', 'REAL'),
+    ('take', 'INTEGER'),
+    ('time', 'INTEGER'),
+    ('n_days', 'INTEGER'),
+    ('threshold', 'REAL'),
+    ('min_trade_qty', 'INTEGER'),
+    ('max_decrements', 'INTEGER'),
+    ('min_decrements', 'INTEGER'),
+    ('trade_gain_len', 'INTEGER'),
+    ('min_up_down_diff', 'INTEGER')
+]
+
+METRIC_COLUMNS = [
+    ('balance', 'REAL'),
+    ('real_profit', 'REAL'),
+    ('real_max_profit', 'REAL'),
+    ('real_max_profit_time', 'TEXT'),
+    ('stop', 'INTEGER'),
+    ('max_drawdown', 'REAL'),
+    # per-type trade counts from summary(), which keeps them in every mode
+    ('n_long', 'INTEGER'),
+    ('n_sell', 'INTEGER'),
+    ('n_short', 'INTEGER'),
+    ('n_cover', 'INTEGER')
+]
+
+COLUMNS = [('run_id', 'TEXT'), ('day', 'TEXT')] + PARAM_COLUMNS + METRIC_COLUMNS
+
+# Append-only table of per-(combination, date) outcomes, one typed column per
+# parameter and metric. Rows are buffered and inserted batch_size at a time.
+class ResultsLog:
+    def __init__(self, path=RESULTS_LOG_PATH, run_id=None, batch_size=1000):
+        self.path = path
+        self.run_id = run_id or datetime.now().strftime('%Y%m%d%H%M%S')
+        self.batch_size = batch_size
+        self.rows = []
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS results ({', '.join(f'{name} {kind}' for name, kind in COLUMNS)})")
+        self.conn.commit()
+
+    def append(self, day, results):
+        day = '-'.join(f"{part:02d}" for part in day) if isinstance(day, tuple) else day.strftime('%Y-%m-%d')
+        for result in results:
+            transactions = result['transactions']
+            self.rows.append((self.run_id, day) + tuple(result['combination']) + (
+                result['balance'], result['real_profit'], result['real_max_profit'],
+                result['real_max_profit_time'].isoformat() if result['real_max_profit_time'] else None,
+                int(result['stop']), result.get('max_drawdown'),
+                transactions.get('LONG', 0), transactions.get('SELL', 0), transactions.get('SHORT', 0), transactions.get('COVER', 0)
+            ))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        self.conn.executemany(f"INSERT INTO results VALUES ({', '.join('?' for column in COLUMNS)})", self.rows)
+        self.conn.commit()
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def where(self, run_id=None, day=None):
+        clauses = []
+        args = []
+        if run_id is not None:
+            clauses.append('run_id = ?')
+            args.append(run_id)
+        if day is not None:
+            clauses.append('day = ?')
+            args.append(day)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), args
+
+    # Both queries walk the cursor row by row and keep only a k-sized heap.
+    def top_k(self, k, metric='real_profit', run_id=None, day=None):
+        self.flush()
+        where, args = self.where(run_id, day)
+        cursor = self.conn.execute(f"SELECT {', '.join(name for name, kind in COLUMNS)} FROM results{where}", args)
+        names = [name for name, kind in COLUMNS]
+        rows = (dict(zip(names, row)) for row in cursor)
+        return heapq.nlargest(k, rows, key=lambda row: row[metric] if row[metric] is not None else float('-inf'))
+
+    def top_combinations(self, k, metric='real_profit', run_id=None):
+        self.flush()
+        where, args = self.where(run_id)
+        params = ', '.join(name for name, kind in PARAM_COLUMNS)
+        cursor = self.conn.execute(
+            f"SELECT {params}, count(*), sum({metric}), avg({metric}), min({metric}) FROM results{where} GROUP BY {params}", args)
+        rows = (
+            {'combination': tuple(row[:len(PARAM_COLUMNS)]), 'days': row[-4], 'total': row[-3], 'mean': row[-2], 'worst': row[-1]}
+            for row in cursor
+        )
+        return heapq.nlargest(k, rows, key=lambda row: row['total'])
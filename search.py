@@ -0,0 +1,83 @@
+import math
+import numpy as np
+
+# Tree-structured Parzen estimator over a discrete space: one ordered list of
+# values per strategy parameter, in combination order. Observations are split
+# into the best `gamma` fraction and the rest; candidates are drawn from the
+# per-parameter densities of the good ones and ranked by l(x) / g(x).
+class TPESearch:
+    def __init__(self, space, gamma=0.25, n_startup=20, n_candidates=256, prior_weight=1.0, seed=None):
+        self.space = [list(values) for values in space]
+        self.value_index = [{value: i for i, value in enumerate(values)} for values in self.space]
+        self.gamma = gamma
+        self.n_startup = n_startup
+        self.n_candidates = n_candidates
+        self.prior_weight = prior_weight
+        self.rng = np.random.default_rng(seed)
+        self.size = math.prod(len(values) for values in self.space)
+        self.picks = []
+        self.scores = []
+        self.seen = set()
+
+    @property
+    def n_observed(self):
+        return len(self.scores)
+
+    @property
+    def exhausted(self):
+        return len(self.seen) >= self.size
+
+    def combination(self, picks):
+        return tuple(values[i] for values, i in zip(self.space, picks))
+
+    def observe(self, combination, score):
+        picks = tuple(index[value] for index, value in zip(self.value_index, combination))
+        self.seen.add(picks)
+        self.picks.append(picks)
+        self.scores.append(score)
+
+    def density(self, picks, dim):
+        k = len(self.space[dim])
+        counts = np.bincount(picks, minlength=k).astype(np.float64)
+        # parameter values are ordered ranges, so let each observation spill
+        # onto its neighbours
+        counts = np.convolve(counts, [0.5, 1, 0.5], mode='same') + self.prior_weight / k
+        return counts / counts.sum()
+
+    def uniform(self, n):
+        return np.stack([self.rng.integers(0, len(values), n) for values in self.space], axis=1)
+
+    def candidates(self, n):
+        if self.n_observed < self.n_startup:
+            return self.uniform(n)
+
+        order = np.argsort(self.scores)[::-1]
+        n_good = max(1, int(math.ceil(self.gamma * self.n_observed)))
+        picks = np.array(self.picks)
+        good = picks[order[:n_good]]
+        bad = picks[order[n_good:]] if self.n_observed > n_good else good
+
+        candidates = np.empty((n, len(self.space)), dtype=np.int64)
+        log_ratio = np.zeros(n)
+        for dim, values in enumerate(self.space):
+            l = self.density(good[:, dim], dim)
+            g = self.density(bad[:, dim], dim)
+            candidates[:, dim] = self.rng.choice(len(values), size=n, p=l)
+            log_ratio += np.log(l[candidates[:, dim]]) - np.log(g[candidates[:, dim]])
+        return candidates[np.argsort(-log_ratio, kind='stable')]
+
+    def propose(self, n):
+        batch = []
+        for attempt in range(4):
+            if len(batch) == n or self.exhausted:
+                break
+            pool = self.candidates(self.n_candidates) if attempt < 2 else self.uniform(self.n_candidates)
+            for row in pool.tolist():
+                picks = tuple(row)
+                if picks in self.seen:
+                    continue
+                self.seen.add(picks)
+                batch.append(self.combination(picks))
+                if len(batch) == n:
+                    break
+        return batch
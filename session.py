@@ -0,0 +1,39 @@
+from datetime import timedelta
+from tape import from_epoch
+
+MORNING = 'morning'
+LUNCH = 'lunch'
+AFTERNOON = 'afternoon'
+
+# lunch runs from 11:30:00 up to and including 12:30:59, as the fixed grid did
+LUNCH_START = (11, 30)
+LUNCH_END = (12, 31)
+
+# The day's steps come from the timestamps actually on the tape, in three
+# segments: morning ticks, a single lunch-close event and afternoon ticks.
+# Rows with no ticker present are skipped, and so is any timestamp less than
+# `interval` seconds after the previous step.
+def session_timeline(tape, start_time, end_time, interval=8):
+    lunch_start = start_time.replace(hour=LUNCH_START[0], minute=LUNCH_START[1], second=0, microsecond=0)
+    lunch_end = start_time.replace(hour=LUNCH_END[0], minute=LUNCH_END[1], second=0, microsecond=0)
+    min_step = timedelta(seconds=interval)
+    has_rows = tape.present.any(axis=1).tolist() if tape.n_ticks else []
+
+    morning = []
+    afternoon = []
+    previous = None
+    for row, timestamp in enumerate(tape.timestamps.tolist()):
+        current_time = from_epoch(timestamp)
+        if current_time < start_time or current_time > end_time or not has_rows[row]:
+            continue
+        if previous is not None and current_time - previous < min_step:
+            continue
+        if current_time < lunch_start:
+            morning.append((MORNING, row, current_time))
+        elif current_time >= lunch_end:
+            afternoon.append((AFTERNOON, row, current_time))
+        else:
+            continue
+        previous = current_time
+
+    return morning + [(LUNCH, None, lunch_start)] + afternoon
@@ -0,0 +1,29 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+def share_arrays(arrays):
+    blocks = {}
+    spec = {}
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        view[...] = array
+        del view
+        blocks[name] = block
+        spec[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, spec
+
+def attach_arrays(spec):
+    blocks = {}
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec.items():
+        blocks[name] = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=blocks[name].buf)
+    return blocks, arrays
+
+def release_arrays(blocks, unlink=False):
+    for block in blocks.values():
+        block.close()
+        if unlink:
+            block.unlink()
@@ -1,95 +1,55 @@
 import psycopg2
+import numpy as np
 from datetime import datetime, timedelta
 from loguru import logger
 from simulator import StockTradingSimulator
+from tape import load_day_tape, to_epoch
+from price_index import load_high_low_index
+from features import build_features, blank_tick, tick_at
+from session import session_timeline, LUNCH
+from shared_arrays import share_arrays, attach_arrays, release_arrays
 import os
 from itertools import product
 import itertools
 from itertools import zip_longest
+import multiprocessing
+import pickle
+import hashlib
+import json
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import monotonic
+from search import TPESearch
+from result_cache import ResultCache, RESULT_CACHE_PATH
+from results_log import ResultsLog
+from phase_timer import PhaseTimer, TimedPriceIndex, NULL_TIMER, merge_timers
+from journal import TradeJournal
 from statistic import *
 
-file_name = os.path.splitext(os.path.basename(__file__))[0]
-os.makedirs("log", exist_ok=True)
-logger.add(sink=f"log/{file_name}.log", level="DEBUG", format="{message}")
-
-def fetch_ticker_id_list(conn):
-    with conn.cursor() as cursor:
-        cursor.execute('SELECT ticker_id FROM ticker_code_mapping')
-        return [row[0] for row in cursor.fetchall()]
-
-def fetch_simulated_metrics_for_time(conn, current_time):
-    cursor = conn.cursor()
-
-    data_query = f"""
-    SELECT 
-        ticker_id, current_price, volume, ask_quantity_total, bid_quantity_total, ask_price_10, bid_price_1
-    FROM real_time_sum_interval_{current_time.strftime('%Y%m%d')}
-    WHERE "timestamp" = %s;
-    """
-    cursor.execute(data_query, (current_time.strftime('%Y-%m-%d %H:%M:%S+09'),))
-    data = cursor.fetchall()
-
-    simulated_metrics = {}
-
-    for row in data:
-        ticker_id = row[0]
-        simulated_metrics[ticker_id] = {
-            'current_price': row[1], 'volume': row[2],
-            'ask_quantity_total': row[3], 'bid_quantity_total': row[4], 
-            'ask_price_10': row[5], 'bid_price_1': row[6]
-        }
-
-    cursor.close()
-    return simulated_metrics
-
-def is_highest_price(conn, ticker_id, price, check_date, n_days, threshold):
-    query = """
-    WITH last_n_days_data AS (
-        SELECT
-            MAX("Close") AS max_price
-        FROM public.historical_data
-        WHERE
-            ticker_id = %s
-            AND date >= %s::timestamp - INTERVAL '1 day' * %s
-            AND date <= %s::timestamp
-    )
-    SELECT %s >= last_n_days_data.max_price * (1 - %s) AS is_highest
-    FROM last_n_days_data;
-    """
-    try:
-        with conn.cursor() as cur:
-            cur.execute(query, (ticker_id, check_date, n_days, check_date, price, threshold))
-            result = cur.fetchone()
-            return result[0]
-    except Exception as e:
-        logger.info(f"Error while checking if the price is the highest: {e}")
-        return True
-
-def is_lowest_price(conn, ticker_id, price, check_date, n_days, threshold):
-    query = """
-    WITH last_n_days_data AS (
-        SELECT
-            MIN("Close") AS min_price
-        FROM public.historical_data
-        WHERE
-            ticker_id = %s
-            AND date >= %s::timestamp - INTERVAL '1 day' * %s
-            AND date <= %s::timestamp
-    )
-    SELECT %s <= last_n_days_data.min_price * (1 + %s) AS is_lowest
-    FROM last_n_days_data;
-    """
-    try:
-        with conn.cursor() as cur:
-            cur.execute(query, (ticker_id, check_date, n_days, check_date, price, threshold))
-            result = cur.fetchone()
-            return result[0]
-    except Exception as e:
-        logger.info(f"Error while checking if the price is the lowest: {e}")
-        return True
-
-def execute_trades(conn, sim, cnt, long_list, short_list):
+CHECKPOINT_DIR = 'checkpoints'
+
+# file sinks are opened by the entry point rather than at import, so importing
+# the simulator (benchmarks, sweeps, workers) does not start a DEBUG log
+def add_log_sinks():
+    os.makedirs("log", exist_ok=True)
+    for name in ['simulate', 'simulator']:
+        logger.add(sink=f"log/{name}.log", level="DEBUG", format="{message}")
+
+def connect():
+    return psycopg2.connect(dbname='stock', user='stock', password='stock', host='localhost')
+
+def is_highest_price(price_index, ticker_id, price, check_date, n_days, threshold):
+    max_price = price_index.max_close(ticker_id, check_date, n_days)
+    if max_price is None:
+        return None
+    return price >= max_price * (1 - threshold)
+
+def is_lowest_price(price_index, ticker_id, price, check_date, n_days, threshold):
+    min_price = price_index.min_close(ticker_id, check_date, n_days)
+    if min_price is None:
+        return None
+    return price <= min_price * (1 + threshold)
+
+def execute_trades(price_index, sim, cnt, long_list, short_list):
     if sim.current_time.hour >= 10:
         return
     long_candidates = [(ticker_id, sim.get_current_long_price(ticker_id)) for ticker_id in long_list]
@@ -107,34 +67,48 @@ def execute_trades(conn, sim, cnt, long_list, short_list):
     for long_item, short_item in zip_longest(long_candidates_combined, short_candidates_combined):
         if long_item:
             ticker_id, long_price = long_item
-            if is_highest_price(conn, ticker_id, long_price, sim.current_time.strftime('%Y-%m-%d'), sim.params[cnt]['n_days'], sim.params[cnt]['threshold']):
+            if is_highest_price(price_index, ticker_id, long_price, sim.current_time.date(), sim.params[cnt]['n_days'], sim.params[cnt]['threshold']):
                 sim.buy_stock(cnt, ticker_id, sim.params[cnt]['min_trade_qty'], long_price)
 
         if short_item:
             ticker_id, short_price = short_item
-            if is_lowest_price(conn, ticker_id, short_price, sim.current_time.strftime('%Y-%m-%d'), sim.params[cnt]['n_days'], sim.params[cnt]['threshold']):
+            if is_lowest_price(price_index, ticker_id, short_price, sim.current_time.date(), sim.params[cnt]['n_days'], sim.params[cnt]['threshold']):
                 sim.short_sell_stock(cnt, ticker_id, sim.params[cnt]['min_trade_qty'], short_price)
 
-def monitor_and_trade(conn, sim, simulated_metrics, current_time):
-    sim.set_metrics(simulated_metrics, current_time)
+def monitor_and_trade(price_index, sim, tick, current_time, timer=NULL_TIMER):
+    phase = timer.phase
+    with phase('set_metrics'):
+        sim.set_metrics(tick, current_time)
+    with phase('update_trade_tickers'):
+        sim.update_trade_tickers()
+    if sim.stop_engine == 'batched':
+        with phase('stops'):
+            sim.evaluate_stops()
 
     for cnt, param in sim.params.items():
         if param['stop']:
             continue
 
-        sim.update_trade_tickers(cnt, simulated_metrics)
-
-        for pos in param['pfl']:
-            sim.apply_stop_loss_and_take_profit(cnt, pos)
+        with phase('stops'):
+            if sim.stop_engine == 'batched':
+                sim.settle_stops(cnt)
+            else:
+                for pos in param['pfl'].scan():
+                    sim.apply_stop_loss_and_take_profit(cnt, pos)
         
-        buying_tickers, short_selling_tickers = sim.get_trade_tickers(cnt, simulated_metrics)
+        with phase('get_trade_tickers'):
+            buying_tickers, short_selling_tickers = sim.get_trade_tickers(cnt)
         
-        execute_trades(conn, sim, cnt, buying_tickers, short_selling_tickers)
+        with phase('execute_trades'):
+            execute_trades(price_index, sim, cnt, buying_tickers, short_selling_tickers)
     
     if sim.single_mode:
-        sim.show_pfl()
-    sim.show_estimated_profit()
+        with phase('show_pfl'):
+            sim.show_pfl()
+    with phase('show_estimated_profit'):
+        sim.show_estimated_profit()
 
+    timer.end_tick()
     return sim
 
 def chunked_iterable(iterable, chunk_size):
@@ -145,80 +119,515 @@ def chunked_iterable(iterable, chunk_size):
             break
         yield chunk
 
-def create_simulators(all_combinations, single_mode, ticker_id_list):
+def create_simulators(all_combinations, single_mode, ticker_id_list, stop_engine='scalar'):
     simulators = []
     chunk_size = max(1, len(all_combinations) // os.cpu_count() + 1)
 
     for chunk in chunked_iterable(all_combinations, chunk_size):
-        sim = StockTradingSimulator(chunk, single_mode, ticker_id_list)
+        sim = StockTradingSimulator(chunk, single_mode, ticker_id_list, stop_engine)
         simulators.append(sim)
 
     return simulators
 
-def simulate(all_combinations, single_mode, proc_mode, year, month, date, interval=8):
-    conn = psycopg2.connect(dbname='stock', user='stock', password='stock', host='localhost')
+def init_shard(sim):
+    for cnt, param in sim.params.items():
+        sim.init_trade_tickers(cnt)
+
+def retreat_shard(sim):
+    for cnt, param in sim.params.items():
+        if param['stop'] == False:
+            sim.retreat(cnt)
+
+def finish_shard(sim, time_max):
+    sim.show_sorted_profit(time_max)
+    results = sim.summary()
+
+    if sim.single_mode:
+        for result in results:
+            for transaction_type, count in result['transactions'].items():
+                sim.log("{}: {}", transaction_type, count)
+
+    if sim.journal is not None:
+        sim.journal.close()
+    return results
+
+def journal_path(journal, shard):
+    return f"{journal}_{shard:03d}.trades"
+
+def snapshot_shard(sim):
+    if sim.journal is not None:
+        sim.journal.flush()
+    return pickle.dumps(sim, pickle.HIGHEST_PROTOCOL)
+
+# a restored shard keeps its journal up to the checkpoint and appends after it
+def open_journal(sim, journal_file, resumed):
+    sim.journal = TradeJournal(journal_file, to_epoch(sim.current_time) if resumed else None)
+
+def restore_shard(snapshot, features, last_row):
+    sim = pickle.loads(snapshot)
+    tick = tick_at(features, last_row, blank_tick(features))
+    sim.set_metrics(tick, sim.current_time)
+    return sim, tick
+
+def shard_worker(pipe, all_combinations, snapshot, single_mode, ticker_id_list, price_index, feature_spec, stop_engine, last_row, timing,
+                 journal_file):
+    blocks, features = attach_arrays(feature_spec)
+    timer = PhaseTimer() if timing else NULL_TIMER
+    if timing:
+        price_index = TimedPriceIndex(price_index, timer)
+    if snapshot is None:
+        sim = StockTradingSimulator(all_combinations, single_mode, ticker_id_list, stop_engine)
+        tick = blank_tick(features)
+    else:
+        sim, tick = restore_shard(snapshot, features, last_row)
+    if journal_file is not None:
+        open_journal(sim, journal_file, snapshot is not None)
+    while True:
+        command, args = pipe.recv()
+        if command == 'init':
+            init_shard(sim)
+        elif command == 'retreat':
+            retreat_shard(sim)
+        elif command == 'tick':
+            row, current_time = args
+            tick = tick_at(features, row, tick)
+            monitor_and_trade(price_index, sim, tick, current_time, timer)
+        elif command == 'snapshot':
+            pipe.send(snapshot_shard(sim))
+        elif command == 'timings':
+            pipe.send([timer] if timing else [])
+        elif command == 'finish':
+            pipe.send(finish_shard(sim, *args))
+            break
 
+    pipe.close()
+    sim.tick = tick = features = None
+    release_arrays(blocks)
+
+class ShardWorkers:
+    def __init__(self, all_combinations, single_mode, ticker_id_list, price_index, features, stop_engine='scalar',
+                 snapshots=None, last_row=None, timing=False, journal=None):
+        self.blocks, feature_spec = share_arrays(features)
+        self.workers = []
+        chunk_size = max(1, len(all_combinations) // os.cpu_count() + 1)
+        chunks = [(chunk, None) for chunk in chunked_iterable(all_combinations, chunk_size)] if snapshots is None else [(None, snapshot) for snapshot in snapshots]
+        for shard, (chunk, snapshot) in enumerate(chunks):
+            parent_pipe, child_pipe = multiprocessing.Pipe()
+            journal_file = journal_path(journal, shard) if journal else None
+            process = multiprocessing.Process(
+                target=shard_worker,
+                args=(child_pipe, chunk, snapshot, single_mode, ticker_id_list, price_index, feature_spec, stop_engine, last_row, timing,
+                      journal_file),
+                daemon=True)
+            process.start()
+            child_pipe.close()
+            self.workers.append((process, parent_pipe))
+
+    def send(self, command, *args):
+        for process, pipe in self.workers:
+            pipe.send((command, args))
+
+    def step(self, row, current_time):
+        self.send('tick', row, current_time)
+
+    def snapshot(self):
+        self.send('snapshot')
+        return [pipe.recv() for process, pipe in self.workers]
+
+    def timings(self):
+        self.send('timings')
+        return [timer for process, pipe in self.workers for timer in pipe.recv()]
+
+    def finish(self, time_max):
+        self.send('finish', time_max)
+        results = []
+        for process, pipe in self.workers:
+            results.extend(pipe.recv())
+            pipe.close()
+            process.join()
+        self.workers = []
+        return results
+
+    def close(self):
+        for process, pipe in self.workers:
+            process.terminate()
+            pipe.close()
+        self.workers = []
+        release_arrays(self.blocks, unlink=True)
+        self.blocks = {}
+
+class LocalShards:
+    def __init__(self, all_combinations, single_mode, ticker_id_list, price_index, features, stop_engine='scalar',
+                 snapshots=None, last_row=None, timing=False, journal=None):
+        self.features = features
+        if snapshots is None:
+            self.simulators = create_simulators(all_combinations, single_mode, ticker_id_list, stop_engine)
+            self.tick = blank_tick(features)
+        else:
+            restored = [restore_shard(snapshot, features, last_row) for snapshot in snapshots]
+            self.simulators = [sim for sim, tick in restored]
+            self.tick = restored[0][1]
+        self.timing = timing
+        self.timers = [PhaseTimer() if timing else NULL_TIMER for sim in self.simulators]
+        self.price_indexes = [TimedPriceIndex(price_index, timer) if timing else price_index for timer in self.timers]
+        if journal:
+            for shard, sim in enumerate(self.simulators):
+                open_journal(sim, journal_path(journal, shard), snapshots is not None)
+
+    def send(self, command, *args):
+        for sim in self.simulators:
+            if command == 'init':
+                init_shard(sim)
+            elif command == 'retreat':
+                retreat_shard(sim)
+
+    def step(self, row, current_time):
+        self.tick = tick_at(self.features, row, self.tick)
+        for sim, timer, price_index in zip(self.simulators, self.timers, self.price_indexes):
+            monitor_and_trade(price_index, sim, self.tick, current_time, timer)
+
+    def snapshot(self):
+        return [snapshot_shard(sim) for sim in self.simulators]
+
+    def timings(self):
+        return self.timers if self.timing else []
+
+    def finish(self, time_max):
+        results = []
+        for sim in self.simulators:
+            results.extend(finish_shard(sim, time_max))
+        return results
+
+    def close(self):
+        for sim in self.simulators:
+            if sim.journal is not None:
+                sim.journal.close()
+
+# names a day's run of one set of combinations, so checkpoints and journals of
+# different sweep units on the same date never share a file
+def run_key(all_combinations, start_time, interval, stop_engine):
+    key = hashlib.sha1(repr(([tuple(combination) for combination in all_combinations], interval, stop_engine)).encode()).hexdigest()[:16]
+    return f"{start_time.strftime('%Y%m%d')}_{key}"
+
+def checkpoint_path(all_combinations, start_time, interval, stop_engine):
+    return os.path.join(CHECKPOINT_DIR, f"{run_key(all_combinations, start_time, interval, stop_engine)}.pkl")
+
+def save_checkpoint(path, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(state, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path):
+    try:
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+def session_bounds(year, month, date):
     start_time = datetime(year, month, date, 9, 1, 0) + timedelta(seconds=8 * (-7))
     # start_time = datetime(year, month, date, 12, 1, 0) + timedelta(seconds=8 * (-7))
     end_time = datetime(year, month, date, 14, 59, 0) + timedelta(seconds=8 * (-37))
     # end_time = datetime(year, month, date, 13, 59, 0) + timedelta(seconds=8 * (-37))
+    return start_time, end_time
 
-    current_time = start_time
-
-    ticker_id_list = fetch_ticker_id_list(conn)
-
-    simulators = create_simulators(all_combinations, single_mode, ticker_id_list)
-
+def report_universe(features, timeline):
+    rows = [row for segment, row, current_time in timeline if row is not None]
+    if not rows:
+        return
+    excluded = np.count_nonzero(~features['eligible'][rows], axis=1)
+    logger.info(f"universe filter: {excluded[0]} of {features['eligible'].shape[1]} tickers never eligible from the open, "
+                f"{excluded[-1]} by the close, {excluded.mean():.0f} excluded per step on average")
+
+def report_timings(day_phases, timers, day):
+    merged = merge_timers(timers)
+    summary = merged.summary()
+    db_seconds = day_phases['db']
+    # close lookups hit the in-memory HighLowIndex inside the replay, so they count as compute
+    price_lookup_seconds = summary.get('price_lookup', {}).get('total', 0.0)
+    compute_seconds = day_phases['features'] + day_phases['replay'] + day_phases['finish']
+    logger.info(f"timing {day}: db {db_seconds:.2f}s, compute {compute_seconds:.2f}s "
+                f"({', '.join(f'{name}: {seconds:.2f}s' for name, seconds in day_phases.items())})")
+    logger.info(f"price lookups (in-memory high/low index): {price_lookup_seconds:.2f}s")
+    logger.info(f"per-tick phase times summed over {len(timers)} shards and {merged.n_ticks} ticks, "
+                f"histogram buckets <0.1ms / <1ms / <10ms / <100ms / <1s / >=1s:")
+    for name, phase in sorted(summary.items(), key=lambda item: -item[1]['total']):
+        logger.info(f"  {name}: {phase['calls']:,} calls, {phase['total']:.2f}s, mean {phase['mean'] * 1000:.3f}ms, "
+                    f"p50 {phase['p50'] * 1000:.3f}ms, p90 {phase['p90'] * 1000:.3f}ms, p99 {phase['p99'] * 1000:.3f}ms, "
+                    f"max {phase['max'] * 1000:.3f}ms, histogram {phase['histogram']}")
+
+    os.makedirs('log', exist_ok=True)
+    path = os.path.join('log', f"timing_{day.replace('-', '')}.json")
+    with open(path, 'w') as file:
+        json.dump({'day': day, 'day_phases': day_phases, 'db_seconds': db_seconds, 'compute_seconds': compute_seconds,
+                   'price_lookup_seconds': price_lookup_seconds,
+                   'n_ticks': merged.n_ticks, 'phases': summary, 'shards': [timer.summary() for timer in timers]}, file, indent=2)
+    logger.info(f"timing written to {path}")
+
+def simulate(all_combinations, single_mode, proc_mode, year, month, date, interval=8, verify_tape=False, progress=True, stop_engine='scalar',
+             result_cache=None, checkpoint_every=None, resume=False, timing=False, journal_dir=None, max_n_days=None):
+    if result_cache and not single_mode:
+        return simulate_cached(all_combinations, proc_mode, year, month, date, interval, verify_tape, progress, stop_engine, result_cache,
+                               checkpoint_every, resume, timing, journal_dir, max_n_days)
+
+    start_time, end_time = session_bounds(year, month, date)
+    day_phases = {}
+
+    started = monotonic()
+    tape = load_day_tape(connect, start_time, verify=verify_tape)
+    # a sweep passes its own lookback so every unit opens the index it prefetched
+    max_n_days = max_n_days or max(combination[3] for combination in all_combinations)
+    price_index = load_high_low_index(connect, start_time, max_n_days, verify=verify_tape)
+    ticker_id_list = tape.ticker_ids.tolist()
+    day_phases['db'] = monotonic() - started
+
+    started = monotonic()
+    features = build_features(tape)
+    day_phases['features'] = monotonic() - started
+
+    path = checkpoint_path(all_combinations, start_time, interval, stop_engine) if checkpoint_every or resume else None
+    snapshot = load_checkpoint(path) if resume else None
     is_init = False
-    while current_time <= end_time:
-        if (current_time.hour == 11 and current_time.minute >= 30) or (current_time.hour == 12 and current_time.minute <= 30):
-            current_time += timedelta(seconds=interval)
-            for sim in simulators:
-                for cnt, param in sim.params.items():
-                    if param['stop'] == False:
-                        sim.retreat(cnt)
-            continue
+    last_row = None
+    n_steps = 0
+    timeline = session_timeline(tape, start_time, end_time, interval)
+    report_universe(features, timeline)
+    if snapshot is not None:
+        logger.info(f"resuming from {path} at {snapshot['current_time']}")
+        timeline = [event for event in timeline if event[2] > snapshot['current_time']]
+        is_init = snapshot['is_init']
+        last_row = snapshot['last_row']
+        n_steps = snapshot['n_steps']
+
+    shard_type = ShardWorkers if proc_mode else LocalShards
+    shards = shard_type(all_combinations, single_mode, ticker_id_list, price_index, features, stop_engine,
+                        snapshot['shards'] if snapshot is not None else None, last_row, timing,
+                        os.path.join(journal_dir, run_key(all_combinations, start_time, interval, stop_engine)) if journal_dir else None)
+    snapshot = None
 
-        if single_mode:
-            logger.info(current_time)
-        else:
-            print(current_time)
-
-        simulated_metrics = fetch_simulated_metrics_for_time(conn, current_time)
-        if is_init == False:
-            for sim in simulators:
-                for cnt, param in sim.params.items():
-                    sim.init_trade_tickers(cnt)
-            is_init = True
-
-        if proc_mode == False:
-            for sim in simulators:
-                sim = monitor_and_trade(conn, sim, simulated_metrics, current_time)
-        else:
-            with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
-                futures = [
-                    executor.submit(monitor_and_trade, conn, sim, simulated_metrics, current_time)
-                    for sim in simulators
-                ]
+    try:
+        started = monotonic()
+        for segment, row, current_time in timeline:
+            if segment == LUNCH:
+                shards.send('retreat')
+                continue
+
+            if single_mode:
+                logger.info(current_time)
+            elif progress:
+                print(current_time)
+
+            if is_init == False:
+                shards.send('init')
+                is_init = True
+
+            shards.step(row, current_time)
+            last_row = row
+            n_steps += 1
+
+            if checkpoint_every and n_steps % checkpoint_every == 0:
+                save_checkpoint(path, {
+                    'current_time': current_time,
+                    'is_init': is_init,
+                    'last_row': last_row,
+                    'n_steps': n_steps,
+                    'shards': shards.snapshot()
+                })
+        day_phases['replay'] = monotonic() - started
+
+        timers = shards.timings() if timing else []
+        started = monotonic()
+        results = shards.finish(start_time.strftime('%Y-%m-%d'))
+        day_phases['finish'] = monotonic() - started
+    finally:
+        shards.close()
+
+    if timing:
+        report_timings(day_phases, timers, start_time.strftime('%Y-%m-%d'))
+
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+    return results
+
+# Only combinations without a stored result for this day, code version and
+# tape are simulated; the rest come straight from the result cache.
+def simulate_cached(all_combinations, proc_mode, year, month, date, interval, verify_tape, progress, stop_engine, result_cache,
+                    checkpoint_every=None, resume=False, timing=False, journal_dir=None, max_n_days=None):
+    day = datetime(year, month, date)
+    if verify_tape:
+        load_day_tape(connect, day, verify=True)
+
+    cache = ResultCache(result_cache, {'interval': interval})
+    try:
+        # a journal needs the trades of every combination, so it replays cached ones too
+        cached = cache.lookup(day, all_combinations) if journal_dir is None else {}
+        missing = [combination for combination in all_combinations if tuple(combination) not in cached]
+        if missing:
+            results = simulate(missing, False, proc_mode, year, month, date, interval, progress=progress, stop_engine=stop_engine,
+                               checkpoint_every=checkpoint_every, resume=resume, timing=timing, journal_dir=journal_dir,
+                               max_n_days=max_n_days)
+            cache.store(day, results)
+            cached.update((result['combination'], result) for result in results)
+    finally:
+        cache.close()
+
+    return [cached[tuple(combination)] for combination in all_combinations]
+
+def prefetch_days(date_combinations, max_n_days, verify_tape=False):
+    for year, month, date in date_combinations:
+        day = datetime(year, month, date)
+        load_day_tape(connect, day, verify=verify_tape)
+        load_high_low_index(connect, day, max_n_days, verify=verify_tape)
+
+# the checkpoint path is keyed by the unit's own combinations, so units of the
+# same date checkpoint and resume independently
+def run_sweep_unit(all_combinations, year, month, date, interval, stop_engine, result_cache, max_n_days, journal_dir=None,
+                   checkpoint_every=None, resume=False):
+    return (year, month, date), simulate(all_combinations, False, False, year, month, date, interval, progress=False, stop_engine=stop_engine,
+                                         result_cache=result_cache, checkpoint_every=checkpoint_every, resume=resume,
+                                         journal_dir=journal_dir, max_n_days=max_n_days)
+
+# Days are independent, so every (date, combination shard) pair is its own unit
+# of work. Caches are filled up front so the pool only ever memory-maps them.
+def run_sweep(all_combinations, date_combinations, interval=8, max_workers=None, verify_tape=False, stop_engine='scalar',
+              result_cache=RESULT_CACHE_PATH, results_log=None, journal_dir=None, checkpoint_every=None, resume=False):
+    if not date_combinations:
+        return {}
+    max_workers = max_workers or os.cpu_count()
+    max_n_days = max(combination[3] for combination in all_combinations)
+    prefetch_days(date_combinations, max_n_days, verify_tape)
+
+    shards_per_date = max(1, -(-max_workers // len(date_combinations)))
+    chunk_size = max(1, -(-len(all_combinations) // shards_per_date))
+
+    day_results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(run_sweep_unit, chunk, year, month, date, interval, stop_engine, result_cache, max_n_days, journal_dir,
+                            checkpoint_every, resume)
+            for year, month, date in date_combinations
+            for chunk in chunked_iterable(all_combinations, chunk_size)
+        ]
+        for future in as_completed(futures):
+            day, results = future.result()
+            day_results.setdefault(day, []).extend(results)
+            if results_log is not None:
+                results_log.append(day, results)
+
+    return day_results
+
+def rank_results(day_results, score='total'):
+    ranking = {}
+    for day, results in sorted(day_results.items()):
+        for result in results:
+            entry = ranking.setdefault(result['combination'], {
+                'combination': result['combination'],
+                'days': 0,
+                'total': 0,
+                'worst': None,
+                'worst_day': None,
+                'max_profit_total': 0
+            })
+            entry['days'] += 1
+            entry['total'] += result['real_profit']
+            entry['max_profit_total'] += result['real_max_profit']
+            if entry['worst'] is None or result['real_profit'] < entry['worst']:
+                entry['worst'] = result['real_profit']
+                entry['worst_day'] = day
+
+    for entry in ranking.values():
+        entry['mean'] = entry['total'] / entry['days']
+
+    return sorted(ranking.values(), key=lambda entry: entry[score], reverse=True)
+
+def show_ranking(ranking, top=None):
+    for rank, entry in enumerate(ranking[:top], 1):
+        worst_day = '-'.join(f"{part:02d}" for part in entry['worst_day'])
+        rung = f", eliminated at rung {entry['eliminated_rung']}" if entry.get('eliminated_rung') is not None else ''
+        logger.info(f"{rank}. {entry['combination']} total: {entry['total']:.0f}, mean: {entry['mean']:.0f}, "
+                    f"worst: {entry['worst']:.0f} ({worst_day}), max profit total: {entry['max_profit_total']:.0f}, days: {entry['days']}{rung}")
+
+# Successive halving over dates: every rung runs the surviving combinations on
+# the next block of dates, ranks them on everything played so far and keeps the
+# top keep_ratio. The date budget grows by 1 / keep_ratio per rung, so each rung
+# costs about the same while the survivors see more and more days.
+def run_successive_halving(all_combinations, date_combinations, keep_ratio=0.5, min_dates=2, score='total',
+                           interval=8, max_workers=None, verify_tape=False, stop_engine='scalar', results_log=None, journal_dir=None,
+                           checkpoint_every=None, resume=False):
+    # keeping everyone is the full sweep, run over every date at once
+    if keep_ratio >= 1:
+        ranking = rank_results(run_sweep(all_combinations, date_combinations, interval, max_workers, verify_tape, stop_engine,
+                                         results_log=results_log, journal_dir=journal_dir, checkpoint_every=checkpoint_every,
+                                         resume=resume), score)
+        for entry in ranking:
+            entry['eliminated_rung'] = None
+        return ranking
+
+    survivors = list(all_combinations)
+    eliminated = {}
+    day_results = {}
+    played = 0
+    n_dates = min(min_dates, len(date_combinations))
+    rung = 0
 
-                for i, future in enumerate(as_completed(futures)):
-                    simulators[i] = future.result()
+    while True:
+        rung_results = run_sweep(survivors, date_combinations[played:n_dates], interval, max_workers, verify_tape, stop_engine,
+                                 results_log=results_log, journal_dir=journal_dir, checkpoint_every=checkpoint_every, resume=resume)
+        for day, results in rung_results.items():
+            day_results.setdefault(day, []).extend(results)
+        played = n_dates
+        if played >= len(date_combinations) or len(survivors) <= 1:
+            break
 
-        current_time += timedelta(seconds=interval)
+        survivor_set = set(tuple(combination) for combination in survivors)
+        ranking = [entry for entry in rank_results(day_results, score) if entry['combination'] in survivor_set]
+        keep = max(1, int(len(ranking) * keep_ratio + 0.5))
+        for entry in ranking[keep:]:
+            eliminated[entry['combination']] = rung
+        survivors = [entry['combination'] for entry in ranking[:keep]]
+        logger.info(f"rung {rung}: {played} dates, kept {keep} of {len(ranking)} combinations")
+
+        n_dates = min(len(date_combinations), max(played + 1, int(played / keep_ratio + 0.5)))
+        rung += 1
+
+    ranking = rank_results(day_results, score)
+    for entry in ranking:
+        entry['eliminated_rung'] = eliminated.get(entry['combination'])
+    # survivors played every date; eliminated ones follow, latest rung first
+    ranking.sort(key=lambda entry: (entry['eliminated_rung'] is not None, -(entry['eliminated_rung'] or 0)))
+    return ranking
+
+# Adaptive alternative to the full grid: each batch is proposed by the search
+# from the scores of the earlier ones and swept over every date. Stops when the
+# evaluation or wall-clock budget is spent or the space runs out.
+def run_search(space, date_combinations, batch_size=32, max_evaluations=None, time_budget=None, score='total', seed=None,
+               interval=8, max_workers=None, verify_tape=False, stop_engine='scalar', results_log=None, journal_dir=None,
+               checkpoint_every=None, resume=False):
+    search = TPESearch(space, seed=seed)
+    started = monotonic()
+    day_results = {}
 
-    for sim in simulators:
-        sim.show_sorted_profit(start_time.strftime('%Y-%m-%d'))
+    while True:
+        n = batch_size if max_evaluations is None else min(batch_size, max_evaluations - search.n_observed)
+        if n <= 0 or (time_budget is not None and monotonic() - started >= time_budget):
+            break
+        batch = search.propose(n)
+        if not batch:
+            break
 
-        if single_mode:
-            for cnt, param in sim.params.items():
-                transaction_summary = {}
-                for transaction in param['transactions']:
-                    transaction_summary[transaction['transaction_type']] = transaction_summary.get(transaction['transaction_type'], 0) + 1
+        batch_results = run_sweep(batch, date_combinations, interval, max_workers, verify_tape, stop_engine, results_log=results_log,
+                                  journal_dir=journal_dir, checkpoint_every=checkpoint_every, resume=resume)
+        for entry in rank_results(batch_results, score):
+            search.observe(entry['combination'], entry[score])
+        for day, results in batch_results.items():
+            day_results.setdefault(day, []).extend(results)
 
-                for transaction_type, count in transaction_summary.items():
-                    sim.log(f"{transaction_type}: {count}")
+        best = max(search.scores)
+        logger.info(f"search: {search.n_observed} of {search.size} combinations evaluated, best {score}: {best:.0f}")
 
-    conn.close()
+    return rank_results(day_results, score)
 
 def read_data_from_file(file_path):
     date_combinations = []
@@ -249,6 +658,18 @@ if __name__ == "__main__":
     min_decrements = range(2, 3)
     trade_gain_len = range(5, 6)
     min_up_down_diff = range(2002, 2003)
+    prune = False
+    keep_ratio = 0.5
+    min_dates = 3
+    search_mode = False
+    batch_size = 32
+    max_evaluations = 256
+    time_budget = None
+    journal_dir = None
+    # journal_dir = 'journal'
+    # checkpoint every n ticks; resume picks up the units a stopped sweep left half done
+    checkpoint_every = None
+    resume = False
     # date_combinations = [(2024, 9, 26), (2024, 9, 27), (2024, 9, 30), (2024, 10, 1), (2024, 10, 2), (2024, 10, 3), (2024, 10, 4),
     #                      (2024, 10, 7), (2024, 10, 8), (2024, 10, 9), (2024, 10, 10), (2024, 10, 11), (2024, 10, 15), (2024, 10, 16),
     #                      (2024, 10, 29), (2024, 10, 30), (2024, 10, 31), (2024, 11, 1), (2024, 11, 5)]
@@ -258,7 +679,7 @@ if __name__ == "__main__":
     # date_combinations = [(2024, 10, 17), (2024, 10, 18), (2024, 10, 21), (2024, 10, 22), (2024, 10, 23)]
     # date_combinations = [(2024, 10, 17)]
 
-    all_combinations = list(product(
+    space = [
         root,
         take,
         time,
@@ -269,12 +690,28 @@ if __name__ == "__main__":
         min_decrements,
         trade_gain_len,
         min_up_down_diff
-    ))
-
-    single_mode = len(date_combinations) <= 1 and len(all_combinations) <= 1
+    ]
 
-    for year, month, date in date_combinations:
-        simulate(all_combinations, single_mode, False, year, month, date, 8)
-    
-    if single_mode:
-        convert_single()
+    add_log_sinks()
+    results_log = ResultsLog()
+    try:
+        if search_mode:
+            show_ranking(run_search(space, date_combinations, batch_size, max_evaluations, time_budget, results_log=results_log,
+                                    journal_dir=journal_dir, checkpoint_every=checkpoint_every, resume=resume))
+        else:
+            all_combinations = list(product(*space))
+
+            single_mode = len(date_combinations) <= 1 and len(all_combinations) <= 1
+
+            if single_mode:
+                for year, month, date in date_combinations:
+                    simulate(all_combinations, single_mode, False, year, month, date, 8)
+                convert_single()
+            elif prune:
+                show_ranking(run_successive_halving(all_combinations, date_combinations, keep_ratio, min_dates, results_log=results_log,
+                                                 journal_dir=journal_dir, checkpoint_every=checkpoint_every, resume=resume))
+            else:
+                show_ranking(rank_results(run_sweep(all_combinations, date_combinations, results_log=results_log, journal_dir=journal_dir,
+                                                    checkpoint_every=checkpoint_every, resume=resume)))
+    finally:
+        results_log.close()
@@ -1,39 +1,50 @@
 from loguru import logger
 from datetime import datetime, timedelta
-import os
 import numpy as np
-
-file_name = os.path.splitext(os.path.basename(__file__))[0]
-os.makedirs("log", exist_ok=True)
-logger.add(sink=f"log/{file_name}.log", level="DEBUG", format="{message}")
+from features import FEATURE_PRICES, MAX_PRICE, MIN_VOLUME
+from portfolio import Lot, Position, Portfolio, PositionBook, to_micros
+from stops import evaluate_stops
+from equity import EquityTracker
+from trend import TrendGroup, TrendFork, TREND_INPUTS, SHORT_SIGNAL_RESET, LONG_SIGNAL_RESET
+from tape import to_epoch
 
 class StockTradingSimulator:
-    def __init__(self, all_combinations, single_mode, ticker_id_list):
+    def __init__(self, all_combinations, single_mode, ticker_id_list, stop_engine='scalar'):
         self.fee_percentage = 0.003
         self.tax_rate = 0.2
-        self.current_metrics = {}
-        self.last_values = {
-            'current_prices': {},
-            'volume': {},
-            'ask_prices': {},
-            'bid_prices': {}
-        }
         self.max_ask_bid_price_diff = 0.00036
-        self.max_price = 15000
+        self.max_price = MAX_PRICE
         self.gain_len = 3
         self.loss_len = 7
         self.stop_loss_thres = 0.04
         self.take_profit_thres = 0.09
-        self.min_volume = 64000
+        self.min_volume = MIN_VOLUME
         self.trade_qty = 2500
         self.profit_levels = [0.01, 0.03, 0.05, 0.07, 0.09, 0.11]
         self.params = {}
         self.ticker_id_list = ticker_id_list
+        self.ticker_index = {ticker_id: col for col, ticker_id in enumerate(ticker_id_list)}
+        self.tick = None
+        self.values = {}
+        self.candidate_mask = None
+        self.trend_groups = {}
+        self.trend_inputs = None
+        self.stop_engine = stop_engine
+        self.stop_params = None
+        self.stop_rows = {}
+        self.stop_decisions = {}
+        self.stop_lot_exits = set()
+        self.stop_positions = []
+        self.book = PositionBook(self.ticker_index)
+        self.journal = None
         cnt = 0
-        for root, take, time, n_days, threshold, min_trade_qty, max_decrements, min_decrements, trade_gain_len, min_up_down_diff in all_combinations:
+        for combination in all_combinations:
+            root, take, time, n_days, threshold, min_trade_qty, max_decrements, min_decrements, trade_gain_len, min_up_down_diff = combination
             self.params[cnt] = {
-                'pfl': [],
+                'combination': tuple(combination),
+                'pfl': Portfolio(self.book, cnt),
                 'transactions': [],
+                'transaction_counts': {},
                 'balance': 3500000,
                 'init_balance': 3500000,
                 'max_profit': {'time': None, 'value': -10000000},
@@ -41,7 +52,7 @@ class StockTradingSimulator:
                 'profit': 0,
                 'real_profit': 0,
                 'ticker_len': 9,
-                'trend_data': {},
+                'trend_data': None,
                 'price_history': {},
                 'min_diff': 0.0144,
                 'max_diff': 0.0225,
@@ -71,77 +82,58 @@ class StockTradingSimulator:
             #print(self.params[cnt]['step_thresholds'])
             cnt += 1
         
+        self.equity = EquityTracker(len(self.params))
         self.single_mode = single_mode
     
-    def log(self, message):
+    # per-tick caches are rebuilt by set_metrics / evaluate_stops, so snapshots
+    # leave them out
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['tick', 'values', 'candidate_mask', 'trend_inputs', 'stop_rows', 'stop_decisions', 'stop_lot_exits', 'stop_positions',
+                     'journal']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tick = None
+        self.values = {}
+        self.candidate_mask = None
+        self.trend_inputs = None
+        self.stop_rows = {}
+        self.stop_decisions = {}
+        self.stop_lot_exits = set()
+        self.stop_positions = []
+        self.journal = None
+
+    # message is only formatted with args when it is actually written
+    def log(self, message, *args):
         if self.single_mode:
-            logger.info(message)
+            logger.info(message, *args)
 
-    def set_metrics(self, simulated_metrics, current_time):
-        self.current_time = current_time
-        self.current_metrics.clear()
-        for ticker_id, metrics in simulated_metrics.items():
-            self.current_metrics[ticker_id] = metrics
-            current_price = self.get_current_price(ticker_id)
-            short_price = self.get_current_short_price(ticker_id)
-            long_price = self.get_current_long_price(ticker_id)
-            volume = self.get_current_volume(ticker_id)
+    def journal_trade(self, cnt, ticker_id, action, price, qty, pnl=0.0):
+        if self.journal is not None:
+            self.journal.record(to_epoch(self.current_time), self.params[cnt]['combination'], ticker_id, action, price, qty, pnl)
 
-    def get_metric(self, ticker_id, metric_name):
-        return self.current_metrics[ticker_id].get(metric_name, 0)
+    def set_metrics(self, tick, current_time):
+        self.current_time = current_time
+        self.tick = tick
+        self.values = {name: tick[name].tolist() for name in FEATURE_PRICES}
+        # tickers that can never pass the price / volume check again are left
+        # out of the candidate scan
+        self.candidate_mask = tick['present'] & tick['eligible']
 
     def get_current_price(self, ticker_id):
-        current_price = self.get_metric(ticker_id, 'current_price')
-        if current_price is not None and current_price > 0.001:
-            self.last_values['current_prices'][ticker_id] = current_price
-        else:
-            if ticker_id in self.last_values['current_prices']:
-                current_price = self.last_values['current_prices'][ticker_id]
-            else:
-                if ticker_id in self.last_values['ask_prices'] and ticker_id in self.last_values['bid_prices']:
-                    current_price = (self.last_values['bid_prices'][ticker_id] + self.last_values['ask_prices'][ticker_id]) / 2
-                else:
-                    current_price = None
-        return current_price
+        return self.values['current'][self.ticker_index[ticker_id]]
 
     def get_current_volume(self, ticker_id):
-        volume = self.get_metric(ticker_id, 'volume')
-        if volume is not None and volume > 0:
-            self.last_values['volume'][ticker_id] = volume
-        else:
-            if ticker_id in self.last_values['volume']:
-                volume = self.last_values['volume'][ticker_id]
-            else:
-                volume = 1000000000
-        return volume
+        return self.values['volume'][self.ticker_index[ticker_id]]
 
     def get_current_short_price(self, ticker_id):
-        bid_price = self.get_metric(ticker_id, 'bid_price_1')
-        if bid_price > 0.001:
-            self.last_values['bid_prices'][ticker_id] = bid_price
-        else:
-            if ticker_id in self.last_values['bid_prices']:
-                bid_price = self.last_values['bid_prices'][ticker_id]
-            else:
-                if ticker_id in self.last_values['current_prices']:
-                    bid_price = self.last_values['current_prices'][ticker_id] * 0.999
-                else:
-                    bid_price = -1
-        return bid_price
+        return self.values['short'][self.ticker_index[ticker_id]]
 
     def get_current_long_price(self, ticker_id):
-        ask_price = self.get_metric(ticker_id, 'ask_price_10')
-        if ask_price > 0.001:
-            self.last_values['ask_prices'][ticker_id] = ask_price
-        else:
-            if ticker_id in self.last_values['ask_prices']:
-                ask_price = self.last_values['ask_prices'][ticker_id]
-            else:
-                if ticker_id in self.last_values['current_prices']:
-                    ask_price = self.last_values['current_prices'][ticker_id] * 1.001
-                else:
-                    ask_price = 1000000000
-        return ask_price
+        return self.values['long'][self.ticker_index[ticker_id]]
 
     def buy_stock(self, cnt, ticker_id, qty, price=None):
         price = self.get_current_long_price(ticker_id) if price is None else price
@@ -159,78 +151,73 @@ class StockTradingSimulator:
         else:
             is_margin = True
         
-        self.log(f"buy_stock: {ticker_id}, quantity: {qty}")
-        existing_entry = next((entry for entry in self.params[cnt]['pfl'] if entry['ticker_id'] == ticker_id), None)
+        self.log("buy_stock: {}, quantity: {}", ticker_id, qty)
+        existing_entry = self.params[cnt]['pfl'].first(ticker_id)
 
         if existing_entry:
-            existing_entry['prices'].append({'price': price, 'qty': qty, 'margin': is_margin})
+            self.params[cnt]['pfl'].add_lot(existing_entry, Lot(price, qty, is_margin))
         else:
-            self.params[cnt]['pfl'].append({
-                'ticker_id': ticker_id,
-                'prices': [{'price': price, 'qty': qty, 'margin': is_margin}],
-                'pos_type': 'LONG',
-                'max_price': price,
-                'min_from_max_price': price,
-                'min_price': price,
-                'down_step': 0,
-                'down_from_max_step': 0,
-                'up_step': 0,
-                'time': self.current_time
-            })
+            self.params[cnt]['pfl'].add(Position(ticker_id, 'LONG', Lot(price, qty, is_margin), self.current_time))
+        self.journal_trade(cnt, ticker_id, 'LONG', price, qty)
         
+        self.count_trade(cnt, 'LONG')
         if self.single_mode:
             self.params[cnt]['transactions'].append({'ticker_id': ticker_id, 'price': price, 'transaction_type': 'LONG'})
 
     def sell_stock(self, cnt, ticker_id, qty=0, price=None, price_qty_pair=None):
         price = self.get_current_short_price(ticker_id) if price is None else price
-        entry = next((e for e in self.params[cnt]['pfl'] if e['ticker_id'] == ticker_id and e['pos_type'] == 'LONG'), None)
+        entry = self.params[cnt]['pfl'].get(ticker_id, 'LONG')
         if not entry:
             return
         
         if qty == 0:
-            qty = sum(pair['qty'] for pair in entry['prices'])
+            qty = sum(pair.qty for pair in entry.prices)
 
         total_revenue = 0
         total_tax = 0
         cost = 0
+        basis = 0
         remaining_qty = qty
 
-        price_qty_pairs = [price_qty_pair] if price_qty_pair else entry['prices']
+        price_qty_pairs = [price_qty_pair] if price_qty_pair else entry.prices
 
         to_remove = []
         for pair in price_qty_pairs:
-            available_qty = pair['qty']
+            available_qty = pair.qty
 
             if remaining_qty <= 0:
                 break
 
             sell_qty = min(remaining_qty, available_qty)
             trade_revenue = sell_qty * price
-            if pair['margin']:
-                cost += sell_qty * pair['price']
-            trade_tax = max((price - pair['price']) * sell_qty * self.tax_rate, 0)
+            if pair.margin:
+                cost += sell_qty * pair.price
+            basis += sell_qty * pair.price
+            trade_tax = max((price - pair.price) * sell_qty * self.tax_rate, 0)
 
             total_revenue += trade_revenue
             total_tax += trade_tax
 
-            pair['qty'] -= sell_qty
-            if pair['qty'] == 0:
+            self.params[cnt]['pfl'].reduce_lot(entry, pair, sell_qty)
+            if pair.qty == 0:
                 to_remove.append(pair)
 
             remaining_qty -= sell_qty
 
         for pair in to_remove:
-            entry['prices'].remove(pair)
+            entry.prices.remove(pair)
 
         net_revenue = total_revenue - total_tax
-        self.log(f"sell_stock: {ticker_id}, Revenue: {net_revenue}, Tax: {total_tax}")
+        self.log("sell_stock: {}, Revenue: {}, Tax: {}", ticker_id, net_revenue, total_tax)
+        self.journal_trade(cnt, ticker_id, 'SELL', price, qty - remaining_qty, net_revenue - basis)
 
         self.params[cnt]['balance'] += net_revenue
         self.params[cnt]['balance'] -= cost
         
-        if not entry['prices']:
+        if not entry.prices:
             self.params[cnt]['pfl'].remove(entry)
 
+        self.count_trade(cnt, 'SELL')
         if self.single_mode:
             self.params[cnt]['transactions'].append({'ticker_id': ticker_id, 'price': price, 'transaction_type': 'SELL'})
 
@@ -241,192 +228,156 @@ class StockTradingSimulator:
         if potential_revenue > self.calculate_margin_capacity(cnt):
             return
 
-        self.log(f"short_sell_stock: {ticker_id}, quantity: {qty}")
-        existing_entry = next((entry for entry in self.params[cnt]['pfl'] if entry['ticker_id'] == ticker_id and entry['pos_type'] == 'SHORT'), None)
+        self.log("short_sell_stock: {}, quantity: {}", ticker_id, qty)
+        existing_entry = self.params[cnt]['pfl'].get(ticker_id, 'SHORT')
 
         if existing_entry:
-            existing_entry['prices'].append({'price': price, 'qty': qty, 'margin': True})
+            self.params[cnt]['pfl'].add_lot(existing_entry, Lot(price, qty, True))
         else:
-            self.params[cnt]['pfl'].append({
-                'ticker_id': ticker_id,
-                'prices': [{'price': price, 'qty': qty, 'margin': True}],
-                'pos_type': 'SHORT',
-                'max_price': price,
-                'max_from_min_price': price,
-                'min_price': price,
-                'down_step': 0,
-                'down_from_min_step': 0,
-                'up_step': 0,
-                'time': self.current_time
-            })
+            self.params[cnt]['pfl'].add(Position(ticker_id, 'SHORT', Lot(price, qty, True), self.current_time))
+        self.journal_trade(cnt, ticker_id, 'SHORT', price, qty)
 
+        self.count_trade(cnt, 'SHORT')
         if self.single_mode:
             self.params[cnt]['transactions'].append({'ticker_id': ticker_id, 'price': price, 'transaction_type': 'SHORT'})
 
     def cover_short(self, cnt, ticker_id, qty=0, price=None, price_qty_pair=None):
         price = self.get_current_long_price(ticker_id) if price is None else price
-        entry = next((e for e in self.params[cnt]['pfl'] if e['ticker_id'] == ticker_id and e['pos_type'] == 'SHORT'), None)
+        entry = self.params[cnt]['pfl'].get(ticker_id, 'SHORT')
         if not entry:
             return
         
         if qty == 0:
-            qty = sum(pair['qty'] for pair in entry['prices'])
+            qty = sum(pair.qty for pair in entry.prices)
 
         total_cost = 0
         total_revenue = 0
         total_tax = 0
         remaining_qty = qty
 
-        price_qty_pairs = [price_qty_pair] if price_qty_pair else entry['prices']
+        price_qty_pairs = [price_qty_pair] if price_qty_pair else entry.prices
 
         to_remove = []
         for pair in price_qty_pairs:
-            available_qty = pair['qty']
+            available_qty = pair.qty
             
             if remaining_qty <= 0:
                 break
 
             cover_qty = min(remaining_qty, available_qty)
             cost = cover_qty * price
-            revenue = cover_qty * (pair['price'] - price)
-            tax = max((pair['price'] - price) * cover_qty * self.tax_rate, 0)
+            revenue = cover_qty * (pair.price - price)
+            tax = max((pair.price - price) * cover_qty * self.tax_rate, 0)
             
             total_cost += cost
             total_revenue += revenue
             total_tax += tax
 
-            pair['qty'] -= cover_qty
-            if pair['qty'] == 0:
+            self.params[cnt]['pfl'].reduce_lot(entry, pair, cover_qty)
+            if pair.qty == 0:
                 to_remove.append(pair)
 
             remaining_qty -= cover_qty
 
         for pair in to_remove:
-            entry['prices'].remove(pair)
+            entry.prices.remove(pair)
         
         fee = total_cost * (self.fee_percentage / 100)
         net_revenue = total_revenue - total_tax - fee
         self.params[cnt]['balance'] += net_revenue
-        self.log(f"cover_short: {ticker_id}, Net Revenue: {net_revenue}")
+        self.log("cover_short: {}, Net Revenue: {}", ticker_id, net_revenue)
+        self.journal_trade(cnt, ticker_id, 'COVER', price, qty - remaining_qty, net_revenue)
 
-        if not entry['prices']:
+        if not entry.prices:
             self.params[cnt]['pfl'].remove(entry)
 
+        self.count_trade(cnt, 'COVER')
         if self.single_mode:
             self.params[cnt]['transactions'].append({'ticker_id': ticker_id, 'price': price, 'transaction_type': 'COVER'})
 
+    # per-type counts are kept in every mode; the full transaction list only in single mode
+    def count_trade(self, cnt, transaction_type):
+        counts = self.params[cnt]['transaction_counts']
+        counts[transaction_type] = counts.get(transaction_type, 0) + 1
+
     def calculate_margin_capacity(self, cnt):
         total_pfl_value = self.pfl_value(cnt)
         total_financial_pos = self.params[cnt]['balance'] + total_pfl_value
 
-        total_margin = 0
-        for entry in self.params[cnt]['pfl']:
-            for price_qty_pair in entry['prices']:
-                if price_qty_pair['margin']:
-                    total_margin += price_qty_pair['qty'] * price_qty_pair['price']
-        
+        total_margin = self.params[cnt]['pfl'].margin_notional
         remaining_capacity = 3 * total_financial_pos - total_margin
         return max(remaining_capacity, 0)
     
+    def trend_key(self, cnt):
+        param = self.params[cnt]
+        return (param['min_diff'], param['max_diff'], param['min_price_diff'], param['max_price_diff'])
+
     def init_trade_tickers(self, cnt):
-        for ticker_id in self.ticker_id_list:
-            self.params[cnt]['trend_data'][ticker_id] = {
-                'last_high_total_ask_qty': -1,
-                'last_high_bid_price': -1,
-                'last_low_total_bid_qty': 1000000000,
-                'last_high_total_bid_qty': -1,
-                'last_low_ask_price': 1000000000,
-                'last_low_total_ask_qty': 1000000000,
-                'num_of_ask_qty_inc': 0,
-                'num_of_bid_qty_inc': 0
-            }
-    
-    def update_trade_tickers(self, cnt, simulated_metrics):
-        for ticker_id, metrics in simulated_metrics.items():
-            total_ask_quantity = metrics['ask_quantity_total']
-            total_bid_quantity = metrics['bid_quantity_total']
-            ask_price = self.get_current_long_price(ticker_id)
-            bid_price = self.get_current_short_price(ticker_id)
-            
-            trend_info = self.params[cnt]['trend_data'][ticker_id]
-            min_diff = self.params[cnt]['min_diff']
-            max_diff = self.params[cnt]['max_diff']
-            min_price_diff = self.params[cnt]['min_price_diff']
-            max_price_diff = self.params[cnt]['max_price_diff']
-
-            if (total_ask_quantity > trend_info['last_high_total_ask_qty'] * (1 + min_diff) and 
-                total_bid_quantity < trend_info['last_low_total_bid_qty'] * (1 - min_diff) and
-                ask_price < trend_info['last_low_ask_price'] * (1 - min_price_diff)):
-
-                trend_info['last_high_total_ask_qty'] = total_ask_quantity
-                trend_info['last_low_ask_price'] = ask_price
-                trend_info['last_low_total_bid_qty'] = total_bid_quantity
-                trend_info['num_of_ask_qty_inc'] = trend_info['num_of_ask_qty_inc'] + 1
-
-            elif (total_ask_quantity < trend_info['last_high_total_ask_qty'] * (1 - min_diff) or
-                 total_ask_quantity > trend_info['last_high_total_ask_qty'] * (1 + max_diff) or
-                 total_bid_quantity > trend_info['last_low_total_bid_qty'] * (1 + min_diff) or
-                 total_bid_quantity < trend_info['last_low_total_bid_qty'] * (1 - max_diff) or
-                 ask_price > trend_info['last_low_ask_price'] * (1 + min_price_diff) or
-                 ask_price < trend_info['last_low_ask_price'] * (1 - max_price_diff)):
-
-                trend_info['last_high_total_ask_qty'] = -1
-                trend_info['last_low_ask_price'] = 1000000000
-                trend_info['last_low_total_bid_qty'] = 1000000000
-                trend_info['num_of_ask_qty_inc'] = 0
-
-            if (total_bid_quantity > trend_info['last_high_total_bid_qty'] * (1 + min_diff) and
-                total_ask_quantity < trend_info['last_low_total_ask_qty'] * (1 - min_diff) and
-                bid_price > trend_info['last_high_bid_price'] * (1 + min_price_diff)):
-
-                trend_info['last_high_total_bid_qty'] = total_bid_quantity
-                trend_info['last_high_bid_price'] = bid_price
-                trend_info['last_low_total_ask_qty'] = total_ask_quantity
-                trend_info['num_of_bid_qty_inc'] = trend_info['num_of_bid_qty_inc'] + 1
-            
-            elif (total_bid_quantity < trend_info['last_high_total_bid_qty'] * (1 - min_diff) or
-                 total_bid_quantity > trend_info['last_high_total_bid_qty'] * (1 + max_diff) or
-                 total_ask_quantity > trend_info['last_low_total_ask_qty'] * (1 + min_diff) or
-                 total_ask_quantity < trend_info['last_low_total_ask_qty'] * (1 - max_diff) or
-                 bid_price < trend_info['last_high_bid_price'] * (1 - min_diff) or
-                 bid_price > trend_info['last_high_bid_price'] * (1 + max_price_diff)):
-
-                trend_info['last_high_total_bid_qty'] = -1
-                trend_info['last_high_bid_price'] = -1
-                trend_info['last_low_total_ask_qty'] = 1000000000
-                trend_info['num_of_bid_qty_inc'] = 0
-
-    def get_candidate_tickers(self, cnt, simulated_metrics):
+        key = self.trend_key(cnt)
+        if key not in self.trend_groups:
+            self.trend_groups[key] = TrendGroup(len(self.ticker_id_list))
+        self.params[cnt]['trend_data'] = TrendFork(self.trend_groups[key])
+
+    # tickers whose quotes differ from the previous step; None means all of them
+    def changed_tickers(self):
+        inputs = [self.tick[name] for name in TREND_INPUTS]
+        changed = None
+        if self.trend_inputs is not None:
+            changed = np.zeros(len(self.ticker_id_list), dtype=bool)
+            for current, previous in zip(inputs, self.trend_inputs):
+                changed |= current != previous
+        self.trend_inputs = inputs
+        return changed
+
+    # Trend state is kept exact for tickers that can still become candidates and
+    # for any ticker a combination holds or watches: the stop loss reads the
+    # counters of held tickers, and a watched ticker can still be bought. Once a
+    # ticker is none of these it cannot become one again.
+    def trend_active(self):
+        tracked = set()
+        for param in self.params.values():
+            tracked.update(param['price_history'])
+            tracked.update(pos.ticker_id for pos in param['pfl'])
+        if not tracked:
+            return self.tick['eligible']
+        active = self.tick['eligible'].copy()
+        active[[self.ticker_index[ticker_id] for ticker_id in tracked]] = True
+        return active
+
+    def update_trade_tickers(self):
+        changed = self.changed_tickers()
+        active = self.trend_active()
+        for key, group in self.trend_groups.items():
+            group.update(self.tick['ask_quantity_total'], self.tick['bid_quantity_total'],
+                         self.tick['long'], self.tick['short'], self.tick['present'], *key, changed, active)
+
+    def get_candidate_tickers(self, cnt):
         buying_tickers = []
         selling_tickers = []
 
-        pfl_ticker_ids = {entry['ticker_id'] for entry in self.params[cnt]['pfl']}
-        ticker_ids_in_price_history = list(self.params[cnt]['price_history'].keys())
-        ticker_ids = [ticker_id for ticker_id in simulated_metrics.keys() 
-                      if ticker_id not in pfl_ticker_ids and ticker_id not in ticker_ids_in_price_history]
-        
-        for ticker_id in ticker_ids:
-            trend_info = self.params[cnt]['trend_data'][ticker_id]
-            price = self.get_current_price(ticker_id)
-            
-            volume = self.get_current_volume(ticker_id)
-            gain_len = self.gain_len
-            if (trend_info['num_of_ask_qty_inc'] == gain_len and 
-                price < self.max_price and
-                volume > self.min_volume):
+        trend = self.params[cnt]['trend_data']
+        pfl = self.params[cnt]['pfl']
+        price_history = self.params[cnt]['price_history']
+        gain_len = self.gain_len
 
+        for col in trend.hits('num_of_ask_qty_inc', gain_len, self.candidate_mask):
+            ticker_id = self.ticker_id_list[col]
+            if pfl.holds(ticker_id) or ticker_id in price_history:
+                continue
+            if self.get_current_price(ticker_id) < self.max_price and self.get_current_volume(ticker_id) > self.min_volume:
                 selling_tickers.append(ticker_id)
 
-            if (trend_info['num_of_bid_qty_inc'] == gain_len and 
-                price < self.max_price and
-                volume > self.min_volume):
-                
+        for col in trend.hits('num_of_bid_qty_inc', gain_len, self.candidate_mask):
+            ticker_id = self.ticker_id_list[col]
+            if pfl.holds(ticker_id) or ticker_id in price_history:
+                continue
+            if self.get_current_price(ticker_id) < self.max_price and self.get_current_volume(ticker_id) > self.min_volume:
                 buying_tickers.append(ticker_id)
         
         return buying_tickers, selling_tickers
     
-    def get_trade_tickers(self, cnt, simulated_metrics):
-        buying_cad_tickers, selling_cad_tickers = self.get_candidate_tickers(cnt, simulated_metrics)
+    def get_trade_tickers(self, cnt):
+        buying_cad_tickers, selling_cad_tickers = self.get_candidate_tickers(cnt)
         min_price_diff = self.params[cnt]['min_trade_price_diff']
         min_decrements = self.params[cnt]['min_decrements']
         max_decrements = self.params[cnt]['max_decrements']
@@ -435,11 +386,12 @@ class StockTradingSimulator:
         buying_tickers = []
         selling_tickers = []
 
+        short_candidates = set(selling_cad_tickers)
         for ticker_id in buying_cad_tickers + selling_cad_tickers:
             if ticker_id not in self.params[cnt]['price_history']:
                 ask_price = self.get_current_long_price(ticker_id)
                 bid_price = self.get_current_short_price(ticker_id)
-                if ticker_id in selling_cad_tickers:
+                if ticker_id in short_candidates:
                     trade_type = 'short'
                 else:
                     trade_type = 'long'
@@ -454,7 +406,7 @@ class StockTradingSimulator:
             bid_price = self.get_current_short_price(ticker_id)
             price_diff = ask_price - bid_price
 
-            trend_info = self.params[cnt]['trend_data'][ticker_id]
+            trend = self.params[cnt]['trend_data']
             price_hist = self.params[cnt]['price_history'][ticker_id]
             
             if price_hist['trade_type'] == 'short':
@@ -474,10 +426,7 @@ class StockTradingSimulator:
                             del self.params[cnt]['price_history'][ticker_id]
                         except KeyError:
                             pass
-                        trend_info['last_high_total_ask_qty'] = -1
-                        trend_info['last_high_bid_price'] = -1
-                        trend_info['last_low_total_bid_qty'] = 1000000000
-                        trend_info['num_of_ask_qty_inc'] = 0
+                        trend.reset(self.ticker_index[ticker_id], SHORT_SIGNAL_RESET)
 
             if price_hist['trade_type'] == 'long':
                 if ask_price > price_hist['ask_high_price'] * (1 + min_price_diff):
@@ -496,41 +445,37 @@ class StockTradingSimulator:
                             del self.params[cnt]['price_history'][ticker_id]
                         except KeyError:
                             pass
-                        trend_info['last_high_total_bid_qty'] = -1
-                        trend_info['last_low_ask_price'] = 1000000000
-                        trend_info['last_low_total_ask_qty'] = 1000000000
-                        trend_info['num_of_bid_qty_inc'] = 0
+                        trend.reset(self.ticker_index[ticker_id], LONG_SIGNAL_RESET)
 
         # return buying_tickers, selling_tickers
         return selling_tickers, buying_tickers
 
     def pfl_value(self, cnt):
-        total_value = 0
-        for entry in self.params[cnt]['pfl']:
-            for price_qty_pair in entry['prices']:
-                if not price_qty_pair['margin']:
-                    total_value += price_qty_pair['qty'] * self.get_current_price(entry['ticker_id'])
-        return total_value
+        free_qty = self.params[cnt]['pfl'].free_qty
+        if not free_qty:
+            return 0
+        cols = [self.ticker_index[ticker_id] for ticker_id in free_qty]
+        return float(np.dot(list(free_qty.values()), self.tick['current'][cols]))
 
     def show_pfl(self):
         def format_pos(entry, price_qty_pair, target_price, pos_type):
-            col_name = 'down_from_max_step' if pos_type  == 'LONG' else 'down_from_min_step'
-            return (f"({entry['ticker_id']}, Price: {price_qty_pair['price']}, "
-                    f"Current Price: {target_price}, Down Step: {entry['down_step']}, Down From Step: {entry[col_name]}, "
-                    f"Up Step: {entry['up_step']}, Quantity: {price_qty_pair['qty']})")
+            down_from_step = entry.down_from_max_step if pos_type  == 'LONG' else entry.down_from_min_step
+            return (f"({entry.ticker_id}, Price: {price_qty_pair.price}, "
+                    f"Current Price: {target_price}, Down Step: {entry.down_step}, Down From Step: {down_from_step}, "
+                    f"Up Step: {entry.up_step}, Quantity: {price_qty_pair.qty})")
 
         for cnt, param in self.params.items():
             long_poss = []
             short_poss = []
             for entry in self.params[cnt]['pfl']:
-                for price_qty_pair in entry.get('prices', []):
-                    if entry['pos_type'] == 'LONG':
-                        target_price = self.get_current_short_price(entry['ticker_id'])
-                        formatted_position = format_pos(entry, price_qty_pair, target_price, entry['pos_type'])
+                for price_qty_pair in entry.prices:
+                    if entry.pos_type == 'LONG':
+                        target_price = self.get_current_short_price(entry.ticker_id)
+                        formatted_position = format_pos(entry, price_qty_pair, target_price, entry.pos_type)
                         long_poss.append(formatted_position)
-                    elif entry['pos_type'] == 'SHORT':
-                        target_price = self.get_current_long_price(entry['ticker_id'])
-                        formatted_position = format_pos(entry, price_qty_pair, target_price, entry['pos_type'])
+                    elif entry.pos_type == 'SHORT':
+                        target_price = self.get_current_long_price(entry.ticker_id)
+                        formatted_position = format_pos(entry, price_qty_pair, target_price, entry.pos_type)
                         short_poss.append(formatted_position)
 
             if long_poss:
@@ -541,108 +486,263 @@ class StockTradingSimulator:
                 self.log("SHORT Positions:")
                 for pos in short_poss:
                     self.log(pos)
-            self.log(f"Balance: {self.params[cnt]['balance']:,.2f}")
+            self.log("Balance: {:,.2f}", self.params[cnt]['balance'])
     
     def retreat(self, cnt, stop=False):
-        long_poss = [entry for entry in self.params[cnt]['pfl'] if entry['pos_type'] == 'LONG']
+        long_poss = [entry for entry in self.params[cnt]['pfl'] if entry.pos_type == 'LONG']
         for entry in long_poss:
-            self.sell_stock(cnt, entry['ticker_id'])
+            self.sell_stock(cnt, entry.ticker_id)
         
-        short_poss = [entry for entry in self.params[cnt]['pfl'] if entry['pos_type'] == 'SHORT']
+        short_poss = [entry for entry in self.params[cnt]['pfl'] if entry.pos_type == 'SHORT']
         for entry in short_poss:
-            self.cover_short(cnt, entry['ticker_id'])
+            self.cover_short(cnt, entry.ticker_id)
         
         self.params[cnt]['stop'] = stop
     
     def apply_stop_loss_and_take_profit(self, cnt, pos):
-        current_price = self.get_current_short_price(pos['ticker_id']) if pos['pos_type'] == 'LONG' else self.get_current_long_price(pos['ticker_id'])
-        volume = self.get_current_volume(pos['ticker_id'])
+        current_price = self.get_current_short_price(pos.ticker_id) if pos.pos_type == 'LONG' else self.get_current_long_price(pos.ticker_id)
+        volume = self.get_current_volume(pos.ticker_id)
         root = self.params[cnt]['take1'] if volume > 30000 else self.params[cnt]['take1']
         root_volume = volume ** (1 / root)
         min_price_diff = self.params[cnt]['min_stop_price_diff']
         price_diff_unit = self.params[cnt]['min_stop_price_diff'] * 500
 
         profit = 0
-        for price_qty_pair in pos['prices']:
-            profit += self.calculate_profit(pos['pos_type'], current_price, price_qty_pair['price'], price_qty_pair['qty'], price_qty_pair['margin'])
-
-        if pos['pos_type'] == 'LONG':
-            if current_price < pos['min_price'] * (1 - min_price_diff):
-                pos['down_step'] += max(1, int((pos['min_price'] - current_price) / pos['min_price'] / price_diff_unit) if pos['min_price'] > 1 else 0)
-                if pos['down_step'] - pos['up_step'] > self.params[cnt]['min_up_down_diff']:
-                    self.sell_stock(cnt, pos['ticker_id'], 0, price=current_price)
-            elif current_price > pos['max_price'] * (1 + min_price_diff):
-                pos['up_step'] += max(1, int((current_price - pos['max_price']) / pos['max_price'] / price_diff_unit) if pos['max_price'] > 1 else 0)
-                pos['down_from_max_step'] = 0
-                pos['min_from_max_price'] = current_price
-                pos['time'] = self.current_time
-                if pos['up_step'] < 6:
-                    self.buy_stock(cnt, pos['ticker_id'], self.params[cnt]['min_trade_qty'], current_price)
+        for price_qty_pair in pos.prices:
+            profit += self.calculate_profit(pos.pos_type, current_price, price_qty_pair.price, price_qty_pair.qty, price_qty_pair.margin)
+
+        if pos.pos_type == 'LONG':
+            if current_price < pos.min_price * (1 - min_price_diff):
+                pos.down_step += max(1, int((pos.min_price - current_price) / pos.min_price / price_diff_unit) if pos.min_price > 1 else 0)
+                if pos.down_step - pos.up_step > self.params[cnt]['min_up_down_diff']:
+                    self.sell_stock(cnt, pos.ticker_id, 0, price=current_price)
+            elif current_price > pos.max_price * (1 + min_price_diff):
+                pos.up_step += max(1, int((current_price - pos.max_price) / pos.max_price / price_diff_unit) if pos.max_price > 1 else 0)
+                pos.down_from_max_step = 0
+                pos.min_from_max_price = current_price
+                pos.time = self.current_time
+                if pos.up_step < 6:
+                    self.buy_stock(cnt, pos.ticker_id, self.params[cnt]['min_trade_qty'], current_price)
             
-            if current_price < pos['min_from_max_price'] * (1 - min_price_diff):
-                pos['down_from_max_step'] += max(1, int((pos['min_from_max_price'] - current_price) / pos['min_from_max_price'] / price_diff_unit) if pos['min_from_max_price'] > 1 else 0)
-                pos['min_from_max_price'] = current_price
+            if current_price < pos.min_from_max_price * (1 - min_price_diff):
+                pos.down_from_max_step += max(1, int((pos.min_from_max_price - current_price) / pos.min_from_max_price / price_diff_unit) if pos.min_from_max_price > 1 else 0)
+                pos.min_from_max_price = current_price
                 for up_limit, down_limit in self.params[cnt]['step_thresholds']:
-                    if pos['up_step'] >= up_limit:
-                        if pos['down_from_max_step'] >= down_limit:
-                            self.sell_stock(cnt, pos['ticker_id'], 0, price=current_price)
+                    if pos.up_step >= up_limit:
+                        if pos.down_from_max_step >= down_limit:
+                            self.sell_stock(cnt, pos.ticker_id, 0, price=current_price)
                         break
             
-            step = pos['up_step'] if profit > -100000000000 else max(pos['down_from_max_step'], pos['down_step'])
+            step = pos.up_step if profit > -100000000000 else max(pos.down_from_max_step, pos.down_step)
             step = step ** self.params[cnt]['root']
-            if self.current_time - pos['time'] > timedelta(seconds=(self.params[cnt]['time'] - step * root_volume) * 60):
-                self.sell_stock(cnt, pos['ticker_id'], 0, price=current_price)
+            if self.current_time - pos.time > timedelta(seconds=(self.params[cnt]['time'] - step * root_volume) * 60):
+                self.sell_stock(cnt, pos.ticker_id, 0, price=current_price)
 
-            pos['min_price'] = min(pos['min_price'], current_price)
-            pos['max_price'] = max(pos['max_price'], current_price)
+            pos.min_price = min(pos.min_price, current_price)
+            pos.max_price = max(pos.max_price, current_price)
         
-        elif pos['pos_type'] == 'SHORT':
-            if current_price > pos['max_price'] * (1 + min_price_diff):
-                pos['down_step'] += max(1, int((current_price - pos['max_price']) / pos['max_price'] / price_diff_unit) if pos['max_price'] > 1 else 0)
-                if pos['down_step'] - pos['up_step'] > self.params[cnt]['min_up_down_diff']:
-                    self.cover_short(cnt, pos['ticker_id'], 0, price=current_price)
-            elif current_price < pos['min_price'] * (1 - min_price_diff):
-                pos['up_step'] += max(1, int((pos['min_price'] - current_price) / pos['min_price'] / price_diff_unit))
-                pos['down_from_min_step'] = 0
-                pos['max_from_min_price'] = current_price
-                pos['time'] = self.current_time
-                if pos['up_step'] < 6:
-                    self.short_sell_stock(cnt, pos['ticker_id'], self.params[cnt]['min_trade_qty'], current_price)
+        elif pos.pos_type == 'SHORT':
+            if current_price > pos.max_price * (1 + min_price_diff):
+                pos.down_step += max(1, int((current_price - pos.max_price) / pos.max_price / price_diff_unit) if pos.max_price > 1 else 0)
+                if pos.down_step - pos.up_step > self.params[cnt]['min_up_down_diff']:
+                    self.cover_short(cnt, pos.ticker_id, 0, price=current_price)
+            elif current_price < pos.min_price * (1 - min_price_diff):
+                pos.up_step += max(1, int((pos.min_price - current_price) / pos.min_price / price_diff_unit))
+                pos.down_from_min_step = 0
+                pos.max_from_min_price = current_price
+                pos.time = self.current_time
+                if pos.up_step < 6:
+                    self.short_sell_stock(cnt, pos.ticker_id, self.params[cnt]['min_trade_qty'], current_price)
             
-            if current_price > pos['max_from_min_price'] * (1 + min_price_diff):
-                pos['down_from_min_step'] += max(1, int((current_price - pos['max_from_min_price']) / pos['max_from_min_price'] / price_diff_unit) if pos['max_from_min_price'] > 1 else 0)
-                pos['max_from_min_price'] = current_price
+            if current_price > pos.max_from_min_price * (1 + min_price_diff):
+                pos.down_from_min_step += max(1, int((current_price - pos.max_from_min_price) / pos.max_from_min_price / price_diff_unit) if pos.max_from_min_price > 1 else 0)
+                pos.max_from_min_price = current_price
                 for up_limit, down_limit in self.params[cnt]['step_thresholds']:
-                    if pos['up_step'] >= up_limit:
-                        if pos['down_from_min_step'] >= down_limit:
-                            self.cover_short(cnt, pos['ticker_id'], 0, price=current_price)
+                    if pos.up_step >= up_limit:
+                        if pos.down_from_min_step >= down_limit:
+                            self.cover_short(cnt, pos.ticker_id, 0, price=current_price)
                         break
             
-            step = pos['up_step'] if profit > -100000000000 else max(pos['down_from_min_step'], pos['down_step'], pos['up_step'])
+            step = pos.up_step if profit > -100000000000 else max(pos.down_from_min_step, pos.down_step, pos.up_step)
             step = step ** self.params[cnt]['root']
-            if self.current_time - pos['time'] > timedelta(seconds=(self.params[cnt]['time'] - step * root_volume) * 60):
-                self.cover_short(cnt, pos['ticker_id'], 0, price=current_price)
+            if self.current_time - pos.time > timedelta(seconds=(self.params[cnt]['time'] - step * root_volume) * 60):
+                self.cover_short(cnt, pos.ticker_id, 0, price=current_price)
             
-            pos['min_price'] = min(pos['min_price'], current_price)
-            pos['max_price'] = max(pos['max_price'], current_price)
+            pos.min_price = min(pos.min_price, current_price)
+            pos.max_price = max(pos.max_price, current_price)
 
-        for price_qty_pair in pos['prices']:
-            change_diff_rate = abs(current_price - price_qty_pair['price']) / price_qty_pair['price']
+        for price_qty_pair in pos.prices:
+            change_diff_rate = abs(current_price - price_qty_pair.price) / price_qty_pair.price
             
             if change_diff_rate > self.take_profit_thres or change_diff_rate < -self.stop_loss_thres:
-                qty = price_qty_pair['qty']
+                qty = price_qty_pair.qty
                 
-                if pos['pos_type'] == 'LONG':
-                    self.sell_stock(cnt, pos['ticker_id'], qty, price=current_price, price_qty_pair=price_qty_pair)
-                elif pos['pos_type'] == 'SHORT':
-                    self.cover_short(cnt, pos['ticker_id'], qty, price=current_price, price_qty_pair=price_qty_pair)
-
-        param = self.params[cnt]
-        if pos['pos_type'] == 'LONG' and param['trend_data'][pos['ticker_id']]['num_of_ask_qty_inc'] >= self.loss_len:
-            self.sell_stock(cnt, pos['ticker_id'], 0, current_price)
-        elif pos['pos_type'] == 'SHORT' and param['trend_data'][pos['ticker_id']]['num_of_bid_qty_inc'] >= self.loss_len:
-            self.cover_short(cnt, pos['ticker_id'], 0, current_price)
+                if pos.pos_type == 'LONG':
+                    self.sell_stock(cnt, pos.ticker_id, qty, price=current_price, price_qty_pair=price_qty_pair)
+                elif pos.pos_type == 'SHORT':
+                    self.cover_short(cnt, pos.ticker_id, qty, price=current_price, price_qty_pair=price_qty_pair)
+
+        trend = self.params[cnt]['trend_data']
+        col = self.ticker_index[pos.ticker_id]
+        if pos.pos_type == 'LONG' and trend.count('num_of_ask_qty_inc', col) >= self.loss_len:
+            self.sell_stock(cnt, pos.ticker_id, 0, current_price)
+        elif pos.pos_type == 'SHORT' and trend.count('num_of_bid_qty_inc', col) >= self.loss_len:
+            self.cover_short(cnt, pos.ticker_id, 0, current_price)
     
+    def stop_param_arrays(self):
+        if self.stop_params is None:
+            params = list(self.params.values())
+            n_levels = max(len(param['step_thresholds']) for param in params)
+            up_limits = np.full((len(params), n_levels), np.inf)
+            down_limits = np.full((len(params), n_levels), np.inf)
+            for cnt, param in enumerate(params):
+                for level, (up_limit, down_limit) in enumerate(param['step_thresholds']):
+                    up_limits[cnt, level] = up_limit
+                    down_limits[cnt, level] = down_limit
+
+            self.stop_params = {
+                name: np.array([param[name] for param in params], dtype=np.float64)
+                for name in ['take1', 'root', 'time', 'min_up_down_diff', 'min_stop_price_diff']
+            }
+            self.stop_params['up_limits'] = up_limits
+            self.stop_params['down_limits'] = down_limits
+        return self.stop_params
+
+    # Batched stop engine: one vectorized pass over the book rows of every open
+    # position of the running combinations. Combinations where nothing fires
+    # only get their changed stop state written back; the rest are settled by
+    # settle_stops in the same order apply_stop_loss_and_take_profit runs.
+    def evaluate_stops(self):
+        self.stop_rows = {}
+        self.stop_lot_exits = set()
+        book = self.book
+        pos = book.pos
+        n = book.n_positions
+        stopped = np.array([param['stop'] for param in self.params.values()])
+        rows = np.flatnonzero(pos['alive'][:n] & ~stopped[pos['cnt'][:n]])
+        if not len(rows):
+            self.stop_positions = []
+            return
+        rows = rows[np.lexsort((pos['seq'][rows], pos['cnt'][rows]))]
+
+        cnts = pos['cnt'][rows]
+        cols = pos['col'][rows]
+        is_long = pos['is_long'][rows]
+        positions = [book.positions[row] for row in rows.tolist()]
+        trend_count = np.array([
+            self.params[cnt]['trend_data'].count('num_of_ask_qty_inc' if long else 'num_of_bid_qty_inc', col)
+            for cnt, col, long in zip(cnts.tolist(), cols.tolist(), is_long.tolist())
+        ])
+
+        state = {name: pos[name][rows] for name in ['min_price', 'max_price', 'from_price', 'down_step', 'up_step', 'down_from_step']}
+        table = {
+            'is_long': is_long,
+            'current_price': np.where(is_long, self.tick['short'][cols], self.tick['long'][cols]),
+            'volume': self.tick['volume'][cols],
+            'elapsed': to_micros(self.current_time) - pos['time'][rows],
+            'trend_count': trend_count,
+            **state
+        }
+        for name, values in self.stop_param_arrays().items():
+            table[name] = values[cnts]
+
+        # lots in pfl order, so each position's profit adds up in lot order
+        lot_rows = book.live_lots()
+        owner_index = np.full(n, -1)
+        owner_index[rows] = np.arange(len(rows))
+        owners = owner_index[book.lot['owner'][lot_rows]]
+        lot_rows = lot_rows[owners >= 0]
+        lots = {
+            'owner': owners[owners >= 0],
+            'price': book.lot['price'][lot_rows],
+            'qty': book.lot['qty'][lot_rows],
+            'margin': book.lot['margin'][lot_rows]
+        }
+
+        decisions = evaluate_stops(table, lots, self.take_profit_thres, self.stop_loss_thres, self.tax_rate, self.fee_percentage, self.loss_len)
+        lot_exit = decisions.pop('lot_exit')
+        acting = (decisions['down_exit'] | decisions['add'] | decisions['from_exit'] | decisions['time_exit'] | decisions['trend_exit']
+                  | (np.bincount(lots['owner'][lot_exit], minlength=len(rows)) > 0))
+        changed = decisions['reset_time'].copy()
+        for name, values in state.items():
+            changed |= decisions[name] != values
+
+        # settle_stops walks every open position of a combination where something
+        # fires; elsewhere the new state is written straight back
+        settle = np.isin(cnts, np.unique(cnts[acting]))
+        quiet = ~settle
+        quiet_rows = rows[quiet]
+        for name in state:
+            pos[name][quiet_rows] = decisions[name][quiet]
+        pos['time'][rows[quiet & decisions['reset_time']]] = to_micros(self.current_time)
+        for i in np.flatnonzero(quiet & changed).tolist():
+            self.store_stop_state(positions[i], decisions, i)
+
+        self.stop_positions = positions
+        self.stop_decisions = {name: values.tolist() for name, values in decisions.items()}
+        self.stop_decisions['current_price'] = table['current_price'].tolist()
+        self.stop_lot_exits = {book.lots[row] for row in lot_rows[lot_exit].tolist()}
+        for i, cnt in zip(np.flatnonzero(settle).tolist(), cnts[settle].tolist()):
+            self.stop_rows.setdefault(cnt, []).append(i)
+
+    def store_stop_state(self, pos, decisions, i):
+        pos.down_step = int(decisions['down_step'][i])
+        pos.up_step = int(decisions['up_step'][i])
+        if pos.pos_type == 'LONG':
+            pos.down_from_max_step = int(decisions['down_from_step'][i])
+            pos.min_from_max_price = float(decisions['from_price'][i])
+        else:
+            pos.down_from_min_step = int(decisions['down_from_step'][i])
+            pos.max_from_min_price = float(decisions['from_price'][i])
+        if decisions['reset_time'][i]:
+            pos.time = self.current_time
+        pos.min_price = float(decisions['min_price'][i])
+        pos.max_price = float(decisions['max_price'][i])
+
+    # Portfolio.scan() order: the position after one that closed is skipped
+    # this tick and keeps its state
+    def settle_stops(self, cnt):
+        rows = self.stop_rows.get(cnt)
+        if rows is None:
+            return
+        skip = False
+        for i in rows:
+            pos = self.stop_positions[i]
+            if skip:
+                skip = False
+                continue
+            self.settle_stop(cnt, pos, i)
+            skip = pos.closed
+
+    def settle_stop(self, cnt, pos, row):
+        decisions = self.stop_decisions
+        current_price = decisions['current_price'][row]
+        ticker_id = pos.ticker_id
+
+        self.store_stop_state(pos, decisions, row)
+        self.book.store_state(pos)
+        if pos.pos_type == 'LONG':
+            close, add = self.sell_stock, self.buy_stock
+        else:
+            close, add = self.cover_short, self.short_sell_stock
+
+        if decisions['down_exit'][row]:
+            close(cnt, ticker_id, 0, price=current_price)
+        elif decisions['add'][row]:
+            add(cnt, ticker_id, self.params[cnt]['min_trade_qty'], current_price)
+
+        if decisions['from_exit'][row]:
+            close(cnt, ticker_id, 0, price=current_price)
+        if decisions['time_exit'][row]:
+            close(cnt, ticker_id, 0, price=current_price)
+
+        for price_qty_pair in pos.prices:
+            if price_qty_pair in self.stop_lot_exits:
+                close(cnt, ticker_id, price_qty_pair.qty, price=current_price, price_qty_pair=price_qty_pair)
+
+        if decisions['trend_exit'][row]:
+            close(cnt, ticker_id, 0, current_price)
+
     def calculate_profit(self, pos_type, current_price, pos_price, trade_qty, margin):
         price_diff = (current_price - pos_price) if pos_type == 'LONG' else (pos_price - current_price)
         profit = price_diff * trade_qty - max(price_diff * trade_qty * self.tax_rate, 0)
@@ -650,48 +750,71 @@ class StockTradingSimulator:
             profit -= current_price * trade_qty * (self.fee_percentage / 100)
         return profit
 
-    def show_estimated_profit(self, reset=False):
-        for cnt, param in self.params.items():
-            est_balance = self.params[cnt]['balance']
-
-            for entry in self.params[cnt]['pfl']:
-                profit = 0
-                if entry['pos_type'] == 'LONG':
-                    short_price = self.get_current_short_price(entry['ticker_id'])
-                    for price_qty_pair in entry['prices']:
-                        profit = self.calculate_profit(entry['pos_type'], short_price, price_qty_pair['price'], price_qty_pair['qty'], price_qty_pair['margin'])
-                        est_balance += profit
-                        if price_qty_pair['margin'] == False:
-                            est_balance += price_qty_pair['price'] * price_qty_pair['qty']
-                    
-                elif entry['pos_type'] == 'SHORT':
-                    long_price = self.get_current_long_price(entry['ticker_id'])
-                    for price_qty_pair in entry['prices']:
-                        profit = self.calculate_profit(entry['pos_type'], long_price, price_qty_pair['price'], price_qty_pair['qty'], price_qty_pair['margin'])
-                        est_balance += profit
-
-            profit = est_balance - self.params[cnt]['init_balance']
-
-            if profit > self.params[cnt]['max_profit']['value']:
-                self.params[cnt]['max_profit'] = {'time': self.current_time, 'value': profit}
-            self.params[cnt]['profit'] = profit
-
-            real_profit = est_balance - 3500000
-            
-            if real_profit > self.params[cnt]['real_max_profit']['value']:
-                self.params[cnt]['real_max_profit'] = {'time': self.current_time, 'value': real_profit}
-            self.params[cnt]['real_profit'] = real_profit
+    def estimate_balances(self):
+        est_balance = np.array([param['balance'] for param in self.params.values()], dtype=np.float64)
+
+        book = self.book
+        rows = book.live_lots()
+        if not len(rows):
+            return est_balance
+
+        positions = book.lot['owner'][rows]
+        owners = book.pos['cnt'][positions]
+        cols = book.pos['col'][positions]
+        is_long = book.pos['is_long'][positions]
+        current_price = np.where(is_long, self.tick['short'][cols], self.tick['long'][cols])
+        price = book.lot['price'][rows]
+        qty = book.lot['qty'][rows]
+        margin = book.lot['margin'][rows]
+
+        price_diff = np.where(is_long, current_price - price, price - current_price)
+        profit = price_diff * qty - np.maximum(price_diff * qty * self.tax_rate, 0)
+        profit -= np.where(margin, current_price * qty * (self.fee_percentage / 100), 0)
+        cost = np.where(is_long & ~margin, price * qty, 0)
+
+        # add the terms one lot at a time, in pfl order, so every combination
+        # rounds exactly like the running sum did
+        starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+        slots = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+        terms = np.zeros((len(self.params), 2 * (slots.max() + 1)))
+        terms[owners, 2 * slots] = profit
+        terms[owners, 2 * slots + 1] = cost
+        for k in range(terms.shape[1]):
+            est_balance += terms[:, k]
+        return est_balance
 
-            if reset:
-                self.params[cnt]['init_balance'] = est_balance
-                self.params[cnt]['max_profit'] = {'time': None, 'value': -10000000}
-            
-            self.log(f"Profit: {profit:,.0f}")
-            self.log(f"Real profit: {real_profit:,.0f}")
+    def show_estimated_profit(self, reset=False):
+        params = list(self.params.values())
+        est_balance = self.estimate_balances()
+        profit = est_balance - np.array([param['init_balance'] for param in params], dtype=np.float64)
+        real_profit = est_balance - 3500000
+        self.equity.update(real_profit)
+
+        max_profit = np.array([param['max_profit']['value'] for param in params], dtype=np.float64)
+        real_max_profit = np.array([param['real_max_profit']['value'] for param in params], dtype=np.float64)
+        profits = profit.tolist()
+        real_profits = real_profit.tolist()
+        for cnt in np.flatnonzero(profit > max_profit).tolist():
+            self.params[cnt]['max_profit'] = {'time': self.current_time, 'value': profits[cnt]}
+        for cnt in np.flatnonzero(real_profit > real_max_profit).tolist():
+            self.params[cnt]['real_max_profit'] = {'time': self.current_time, 'value': real_profits[cnt]}
+        for param, value, real_value in zip(params, profits, real_profits):
+            param['profit'] = value
+            param['real_profit'] = real_value
+
+        if reset:
+            for param, balance in zip(params, est_balance.tolist()):
+                param['init_balance'] = balance
+                param['max_profit'] = {'time': None, 'value': -10000000}
+
+        retreat = ((profit <= np.array([param['min'] for param in params]) * 1000) |
+                   (profit >= np.array([param['take'] for param in params]) * 1000))
+        for cnt in (self.params if self.single_mode else np.flatnonzero(retreat).tolist()):
+            self.log("Profit: {:,.0f}", profits[cnt])
+            self.log("Real profit: {:,.0f}", real_profits[cnt])
+            if retreat[cnt]:
+                self.retreat(cnt, True)
 
-            if profit <= self.params[cnt]['min'] * 1000 or profit >= self.params[cnt]['take'] * 1000:
-                self.retreat(cnt, True)  
-    
     def show_sorted_profit(self, time_max):
         sorted_params = sorted(
             self.params.items(),
@@ -715,4 +838,19 @@ class StockTradingSimulator:
                 logger.info(f"root: {root}, take: {take}, min_trade_qty: {min_trade_qty}, min_decrements: {min_decrements}, max_decrements: {max_decrements}, trade_gain_len: {trade_gain_len}, time: {time}, time_max: {time_max}, profit: {profit:,.0f}, max_profit: {max_profit_value:,.0f}")
             else:
                 if max_profit_value > -2000000 and profit > -20000000:
-                    logger.info(f"root: {root}, take: {take}, min_trade_qty: {min_trade_qty}, min_decrements: {min_decrements}, max_decrements: {max_decrements}, trade_gain_len: {trade_gain_len}, time: {time}, time_max: {time_max}, profit: {profit:,.0f}, max_profit: {max_profit_value:,.0f}")
\ No newline at end of file
+                    logger.info(f"root: {root}, take: {take}, min_trade_qty: {min_trade_qty}, min_decrements: {min_decrements}, max_decrements: {max_decrements}, trade_gain_len: {trade_gain_len}, time: {time}, time_max: {time_max}, profit: {profit:,.0f}, max_profit: {max_profit_value:,.0f}")
+
+    def summary(self):
+        results = []
+        for cnt, param in self.params.items():
+            results.append({
+                'combination': param['combination'],
+                'balance': param['balance'],
+                'real_profit': param['real_profit'],
+                'real_max_profit': param['real_max_profit']['value'],
+                'real_max_profit_time': param['real_max_profit']['time'],
+                'stop': param['stop'],
+                'max_drawdown': float(self.equity.max_drawdown[cnt]),
+                'transactions': dict(param['transaction_counts'])
+            })
+        return results
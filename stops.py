@@ -0,0 +1,100 @@
+import numpy as np
+from datetime import timedelta
+
+# Steps move by whole multiples of the stop price unit, at least one; a base
+# price at or below 1 (a sentinel price) only ever counts as a single step.
+def step_increment(distance, base, unit, guarded=True):
+    steps = np.maximum(1, np.trunc(distance / base / unit))
+    if guarded:
+        steps = np.where(base > 1, steps, 1)
+    return steps
+
+def first_down_limit(up_step, up_limits, down_limits):
+    down_limit = np.full(len(up_step), np.inf)
+    matched = np.zeros(len(up_step), dtype=bool)
+    for level in range(up_limits.shape[1]):
+        hit = ~matched & (up_step >= up_limits[:, level])
+        down_limit[hit] = down_limits[hit, level]
+        matched |= hit
+    return matched, down_limit
+
+# Vectorized form of apply_stop_loss_and_take_profit for every open position at
+# once. Positions are rows of `book`, lots are rows of `lots` pointing at their
+# position through lots['owner']. Nothing here touches the portfolio: the new
+# per-position state and the exit / add decisions are returned for settlement.
+def evaluate_stops(book, lots, take_profit_thres, stop_loss_thres, tax_rate, fee_percentage, loss_len):
+    is_long = book['is_long']
+    cp = book['current_price']
+    d = book['min_stop_price_diff']
+    unit = book['min_stop_price_diff'] * 500
+    min_price = book['min_price']
+    max_price = book['max_price']
+    from_price = book['from_price']
+
+    with np.errstate(all='ignore'):
+        lot_cp = cp[lots['owner']]
+        price_diff = np.where(is_long[lots['owner']], lot_cp - lots['price'], lots['price'] - lot_cp)
+        lot_profit = price_diff * lots['qty'] - np.maximum(price_diff * lots['qty'] * tax_rate, 0)
+        lot_profit -= np.where(lots['margin'], lot_cp * lots['qty'] * (fee_percentage / 100), 0)
+        profit = np.bincount(lots['owner'], weights=lot_profit, minlength=len(cp))
+
+        lot_rate = np.abs(lot_cp - lots['price']) / lots['price']
+        lot_exit = (lot_rate > take_profit_thres) | (lot_rate < -stop_loss_thres)
+
+        down = np.where(is_long, cp < min_price * (1 - d), cp > max_price * (1 + d))
+        up = ~down & np.where(is_long, cp > max_price * (1 + d), cp < min_price * (1 - d))
+
+        down_inc = np.where(is_long, step_increment(min_price - cp, min_price, unit),
+                            step_increment(cp - max_price, max_price, unit))
+        up_inc = np.where(is_long, step_increment(cp - max_price, max_price, unit),
+                          step_increment(min_price - cp, min_price, unit, guarded=False))
+
+        down_step = book['down_step'] + np.where(down, down_inc, 0)
+        up_step = book['up_step'] + np.where(up, up_inc, 0)
+        down_exit = down & (down_step - book['up_step'] > book['min_up_down_diff'])
+        add = up & (up_step < 6)
+
+        down_from_step = np.where(up, 0, book['down_from_step'])
+        from_price = np.where(up, cp, from_price)
+        elapsed = np.where(up, 0, book['elapsed'])
+
+        fall = np.where(is_long, cp < from_price * (1 - d), cp > from_price * (1 + d))
+        fall_inc = np.where(is_long, step_increment(from_price - cp, from_price, unit),
+                            step_increment(cp - from_price, from_price, unit))
+        down_from_step = down_from_step + np.where(fall, fall_inc, 0)
+        from_price = np.where(fall, cp, from_price)
+        matched, down_limit = first_down_limit(up_step, book['up_limits'], book['down_limits'])
+        from_exit = fall & matched & (down_from_step >= down_limit)
+
+        step = np.where(profit > -100000000000, up_step,
+                        np.where(is_long, np.maximum(down_from_step, down_step),
+                                 np.maximum(np.maximum(down_from_step, down_step), up_step)))
+        root_volume = book['volume'] ** (1 / book['take1'])
+        limit = (book['time'] - step ** book['root'] * root_volume) * 60 * 1000000
+        time_exit = elapsed > limit
+
+    # timedelta rounds the limit to whole microseconds; settle the rows that
+    # sit right on the boundary exactly the way the scalar rule does
+    for row in np.flatnonzero(np.abs(elapsed - limit) <= 2).tolist():
+        scalar_step = int(step[row]) ** float(book['root'][row])
+        scalar_root_volume = float(book['volume'][row]) ** (1 / int(book['take1'][row]))
+        scalar_limit = timedelta(seconds=(float(book['time'][row]) - scalar_step * scalar_root_volume) * 60)
+        time_exit[row] = timedelta(microseconds=int(elapsed[row])) > scalar_limit
+
+    trend_exit = book['trend_count'] >= loss_len
+
+    return {
+        'down_exit': down_exit,
+        'add': add,
+        'from_exit': from_exit,
+        'time_exit': time_exit,
+        'trend_exit': trend_exit,
+        'lot_exit': lot_exit,
+        'down_step': down_step,
+        'up_step': up_step,
+        'down_from_step': down_from_step,
+        'from_price': from_price,
+        'reset_time': up,
+        'min_price': np.minimum(min_price, cp),
+        'max_price': np.maximum(max_price, cp)
+    }
@@ -0,0 +1,93 @@
+import numpy as np
+from datetime import datetime
+from tape import DayTape, TAPE_CACHE_DIR, to_epoch, tape_cache_path, save_day_tape, write_cache
+from price_index import HighLowIndex, PRICE_INDEX_SCHEMA_VERSION, date_epoch, high_low_cache_path
+
+# first tick simulate() steps on
+SESSION_OPEN = (9, 0, 4)
+
+# Deterministic stand-in for a real_time_sum_interval_* day. Mid prices walk
+# in small steps and often stand still, bid / ask sit one to a few ticks apart,
+# and the order-book totals random-walk with occasional one-sided episodes
+# (ask building while bid drains, or the other way) so the trend counters
+# fire. Volume ramps up through the day, faster near the open and close.
+# Some quotes are missing, zero or NaN, as on the real tables.
+def synthetic_day_tape(day, n_tickers=150, n_ticks=2656, seed=0, interval=8, missing_rate=0.01, zero_rate=0.01, episode_rate=0.03):
+    rng = np.random.default_rng(seed)
+    T, N = n_ticks, n_tickers
+    open_time = datetime(day.year, day.month, day.day, *SESSION_OPEN)
+    timestamps = to_epoch(open_time) + interval * np.arange(T, dtype=np.int64)
+    ticker_ids = np.arange(1000, 1000 + N, dtype=np.int64)
+
+    base = np.exp(rng.uniform(np.log(1000), np.log(30000), N)).round(-1)
+    moves = rng.choice([-1, 0, 0, 1], size=(T, N)) * rng.uniform(0.0001, 0.0006, (T, N))
+    mid = base * np.cumprod(1 + moves, axis=0)
+    bid = mid.round(1)
+    ask = (bid * (1 + rng.choice([0.0001, 0.0002, 0.0005], size=(T, N)))).round(1)
+
+    ask_qty = np.empty((T, N))
+    bid_qty = np.empty((T, N))
+    ask_qty[0] = rng.integers(10000, 100000, N)
+    bid_qty[0] = rng.integers(10000, 100000, N)
+    mode = np.zeros(N, dtype=np.int64)
+    left = np.zeros(N, dtype=np.int64)
+    for t in range(1, T):
+        start = (left == 0) & (rng.random(N) < episode_rate)
+        mode[start] = rng.choice([1, 2], np.count_nonzero(start))
+        left[start] = rng.integers(2, 8, np.count_nonzero(start))
+        ask_step = np.where(mode == 1, 1.018, np.where(mode == 2, 0.982, 1 + rng.normal(0, 0.004, N)))
+        bid_step = np.where(mode == 1, 0.982, np.where(mode == 2, 1.018, 1 + rng.normal(0, 0.004, N)))
+        ask_qty[t] = np.round(ask_qty[t - 1] * ask_step)
+        bid_qty[t] = np.round(bid_qty[t - 1] * bid_step)
+        ask[t] = np.where(mode == 1, (ask[t - 1] * (1 - 0.0003)).round(1), ask[t])
+        bid[t] = np.where(mode == 2, (bid[t - 1] * (1 + 0.0003)).round(1), bid[t])
+        left = np.maximum(left - 1, 0)
+        mode[left == 0] = 0
+
+    # trading is busiest around the open and the close
+    ramp = 1 + 2 * (2 * np.arange(T) / max(T - 1, 1) - 1) ** 2
+    rate = rng.lognormal(4, 1, N)
+    volume = np.cumsum(rng.poisson(ramp[:, None] * rate), axis=0) + rng.integers(0, 80000, N)
+
+    current = mid.round(1)
+    current[rng.random((T, N)) < zero_rate] = 0
+    current[1:][rng.random((T - 1, N)) < zero_rate / 2] = np.nan
+    bid[rng.random((T, N)) < zero_rate] = 0
+    ask[rng.random((T, N)) < zero_rate] = 0
+    volume = np.where(rng.random((T, N)) < zero_rate, 0, volume).astype(np.float64)
+
+    present = rng.random((T, N)) >= missing_rate
+    columns = {
+        'current_price': current,
+        'volume': volume,
+        'ask_quantity_total': ask_qty,
+        'bid_quantity_total': bid_qty,
+        'ask_price_10': ask,
+        'bid_price_1': bid
+    }
+    columns = {name: np.where(present, column, np.nan) for name, column in columns.items()}
+    return DayTape(timestamps, ticker_ids, columns, present)
+
+# daily closes for the n_days before `day`, scattered around each ticker's
+# opening price so the high / low filters pass some tickers and reject others
+def synthetic_high_low_index(tape, day, n_days=100, seed=0):
+    rng = np.random.default_rng(seed + 1)
+    with np.errstate(invalid='ignore'):
+        opening = np.nanmax(np.where(tape.columns['current_price'][:20] > 0, tape.columns['current_price'][:20], np.nan), axis=0)
+    opening = np.where(np.isnan(opening), 10000, opening)
+    days = np.arange(n_days + 1)
+    ticker_ids = np.repeat(tape.ticker_ids, len(days))
+    dates = np.tile(date_epoch(day) - days * 86400, tape.n_tickers)
+    closes = np.repeat(opening, len(days)) * rng.uniform(0.98, 1.003, len(ticker_ids))
+    return HighLowIndex(ticker_ids, dates, closes)
+
+# Writes a synthetic day where load_day_tape / load_high_low_index look for
+# it, so simulate() runs on it without a database.
+def write_synthetic_day(day, max_n_days, cache_dir=TAPE_CACHE_DIR, seed=0, **kwargs):
+    tape = synthetic_day_tape(day, seed=seed, **kwargs)
+    index = synthetic_high_low_index(tape, day, max_n_days, seed)
+    stamp = {'synthetic': True, 'seed': seed, **kwargs}
+    save_day_tape(tape, tape_cache_path(day, cache_dir), stamp)
+    arrays = {'ticker_ids': index.ticker_ids, 'dates': index.dates, 'closes': index.closes}
+    write_cache(high_low_cache_path(day, max_n_days, cache_dir), arrays, {'schema_version': PRICE_INDEX_SCHEMA_VERSION, 'stamp': stamp})
+    return tape, index
@@ -0,0 +1,179 @@
+import io
+import os
+import json
+import shutil
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from loguru import logger
+
+KST = timezone(timedelta(hours=9))
+
+TAPE_SCHEMA_VERSION = 1
+TAPE_CACHE_DIR = 'tape_cache'
+
+TAPE_COLUMNS = ['current_price', 'volume', 'ask_quantity_total', 'bid_quantity_total', 'ask_price_10', 'bid_price_1']
+
+def to_epoch(current_time):
+    return int(current_time.replace(tzinfo=KST).timestamp())
+
+def from_epoch(timestamp):
+    return datetime.fromtimestamp(int(timestamp), KST).replace(tzinfo=None)
+
+class DayTape:
+    def __init__(self, timestamps, ticker_ids, columns, present):
+        self.timestamps = timestamps
+        self.ticker_ids = ticker_ids
+        self.columns = columns
+        self.present = present
+        self.ticker_index = {ticker_id: col for col, ticker_id in enumerate(ticker_ids.tolist())}
+
+    @property
+    def n_ticks(self):
+        return len(self.timestamps)
+
+    @property
+    def n_tickers(self):
+        return len(self.ticker_ids)
+
+def build_day_tape(rows, ticker_id_list):
+    rows = np.asarray(rows, dtype=np.float64).reshape(-1, 2 + len(TAPE_COLUMNS))
+    timestamps, tick_rows = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+    row_ticker_ids = rows[:, 1].astype(np.int64)
+    ticker_ids = np.union1d(np.asarray(ticker_id_list, dtype=np.int64), row_ticker_ids)
+    ticker_cols = np.searchsorted(ticker_ids, row_ticker_ids)
+
+    shape = (len(timestamps), len(ticker_ids))
+    present = np.zeros(shape, dtype=bool)
+    present[tick_rows, ticker_cols] = True
+
+    columns = {}
+    for k, name in enumerate(TAPE_COLUMNS):
+        column = np.full(shape, np.nan)
+        column[tick_rows, ticker_cols] = rows[:, 2 + k]
+        columns[name] = column
+
+    return DayTape(timestamps, ticker_ids, columns, present)
+
+def fetch_ticker_id_list(conn):
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT ticker_id FROM ticker_code_mapping')
+        return [row[0] for row in cursor.fetchall()]
+
+def fetch_day_tape(conn, day, ticker_id_list):
+    copy_query = f"""
+    COPY (
+        SELECT
+            extract(epoch FROM "timestamp")::bigint, ticker_id, current_price, volume, ask_quantity_total, bid_quantity_total, ask_price_10, bid_price_1
+        FROM real_time_sum_interval_{day.strftime('%Y%m%d')}
+        ORDER BY "timestamp", ticker_id
+    ) TO STDOUT WITH (FORMAT csv, NULL 'nan')
+    """
+    buf = io.StringIO()
+    with conn.cursor() as cursor:
+        cursor.copy_expert(copy_query, buf)
+
+    if buf.tell() == 0:
+        return build_day_tape([], ticker_id_list)
+
+    buf.seek(0)
+    rows = np.loadtxt(buf, delimiter=',', dtype=np.float64, ndmin=2)
+    return build_day_tape(rows, ticker_id_list)
+
+def fetch_tape_stamp(conn, day):
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+        SELECT count(*), extract(epoch FROM max("timestamp"))::bigint
+        FROM real_time_sum_interval_{day.strftime('%Y%m%d')}
+        """)
+        row_count, max_timestamp = cursor.fetchone()
+    return {'row_count': row_count, 'max_timestamp': max_timestamp}
+
+def tape_cache_path(day, cache_dir=TAPE_CACHE_DIR):
+    return os.path.join(cache_dir, f"{day.strftime('%Y%m%d')}_v{TAPE_SCHEMA_VERSION}")
+
+def write_cache(path, arrays, meta):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process finished writing the same entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def read_cache(path, names):
+    with open(os.path.join(path, 'meta.json'), 'r') as file:
+        meta = json.load(file)
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in names}
+    return arrays, meta
+
+def save_day_tape(tape, path, stamp):
+    arrays = {'timestamps': tape.timestamps, 'ticker_ids': tape.ticker_ids, 'present': tape.present}
+    arrays.update(tape.columns)
+    write_cache(path, arrays, {'schema_version': TAPE_SCHEMA_VERSION, 'stamp': stamp})
+
+def open_day_tape(path):
+    arrays, meta = read_cache(path, ['timestamps', 'ticker_ids', 'present'] + TAPE_COLUMNS)
+    columns = {name: arrays[name] for name in TAPE_COLUMNS}
+    tape = DayTape(arrays['timestamps'], arrays['ticker_ids'], columns, arrays['present'])
+    return tape, meta
+
+def sampling_report(tape):
+    report = {'n_ticks': tape.n_ticks, 'interval': None, 'n_gaps': 0, 'max_gap': 0, 'n_dense': 0, 'n_off_grid': 0}
+    if tape.n_ticks < 2:
+        return report
+
+    gaps = np.diff(np.asarray(tape.timestamps))
+    interval = int(np.median(gaps))
+    report.update({
+        'interval': interval,
+        'n_gaps': int(np.count_nonzero(gaps > 1.5 * interval)),
+        'max_gap': int(gaps.max()),
+        'n_dense': int(np.count_nonzero(gaps < interval)),
+        'n_off_grid': int(np.count_nonzero(gaps % interval)) if interval else 0
+    })
+    return report
+
+def report_sampling(tape, day):
+    report = sampling_report(tape)
+    if report['n_gaps'] or report['n_dense'] or report['n_off_grid']:
+        logger.warning(f"tape {day.strftime('%Y-%m-%d')} sampled irregularly: {report['n_ticks']} ticks every {report['interval']}s, "
+                       f"{report['n_gaps']} gaps (longest {report['max_gap']}s), {report['n_dense']} dense, {report['n_off_grid']} off grid")
+    return report
+
+def load_day_tape(connect, day, cache_dir=TAPE_CACHE_DIR, verify=False):
+    tape = read_day_tape(connect, day, cache_dir, verify)
+    report_sampling(tape, day)
+    return tape
+
+def read_day_tape(connect, day, cache_dir=TAPE_CACHE_DIR, verify=False):
+    path = tape_cache_path(day, cache_dir)
+    conn = None
+    try:
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            tape, meta = open_day_tape(path)
+            if meta.get('schema_version') == TAPE_SCHEMA_VERSION:
+                if not verify:
+                    return tape
+                conn = connect()
+                if fetch_tape_stamp(conn, day) == meta['stamp']:
+                    return tape
+
+        conn = conn or connect()
+        stamp = fetch_tape_stamp(conn, day)
+        tape = fetch_day_tape(conn, day, fetch_ticker_id_list(conn))
+    finally:
+        if conn is not None:
+            conn.close()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    save_day_tape(tape, path, stamp)
+    return open_day_tape(path)[0]
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+from tape import build_day_tape, to_epoch
+from features import build_features, feature_tick
+from simulator import StockTradingSimulator
+
+COMBINATION = (1.0, 5, 65, 78, 0.007, 300, 5, 2, 5, 2002)
+
+# One ticker bought just under MAX_PRICE that then trades above it, while the
+# ask side keeps building: the loss_len trend exit must still close the long.
+def held_over_max_price_tape(n_ticks=12):
+    start = datetime(2024, 10, 17, 9, 0, 4)
+    rows = []
+    for row in range(n_ticks):
+        current = 14900 if row == 0 else 15100
+        ask_qty = 50000 * 1.02 ** row
+        bid_qty = 50000 * 0.98 ** row
+        ask = 15120 * (1 - 0.0002 * row)
+        rows.append([to_epoch(start + timedelta(seconds=8 * row)), 1000, current, 100000, ask_qty, bid_qty, ask, 15100])
+    return build_day_tape(rows, [1000])
+
+def replay(tape, stop_engine):
+    features = build_features(tape)
+    sim = StockTradingSimulator([COMBINATION], False, tape.ticker_ids.tolist(), stop_engine)
+    sim.init_trade_tickers(0)
+    closed_at = None
+    for row, timestamp in enumerate(tape.timestamps.tolist()):
+        current_time = datetime(2024, 10, 17, 9, 0, 4) + timedelta(seconds=8 * row)
+        sim.set_metrics(feature_tick(features, row), current_time)
+        sim.update_trade_tickers()
+        if row == 0:
+            sim.buy_stock(0, 1000, 300)
+            continue
+        if stop_engine == 'batched':
+            sim.evaluate_stops()
+            sim.settle_stops(0)
+        else:
+            for pos in sim.params[0]['pfl'].scan():
+                sim.apply_stop_loss_and_take_profit(0, pos)
+        if closed_at is None and not sim.params[0]['pfl'].holds(1000):
+            closed_at = row
+    return sim, features, closed_at
+
+def test_held_ticker_keeps_trend_state_after_crossing_max_price():
+    tape = held_over_max_price_tape()
+    for stop_engine in ['scalar', 'batched']:
+        sim, features, closed_at = replay(tape, stop_engine)
+        assert not features['eligible'][1:, 0].any()
+        assert closed_at is not None
+        assert sim.params[0]['balance'] != 3500000
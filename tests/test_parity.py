@@ -0,0 +1,109 @@
+import pickle
+import numpy as np
+from datetime import datetime, timedelta
+from itertools import product
+from tape import build_day_tape, to_epoch
+from features import build_features, feature_tick, blank_tick, tick_at
+from simulator import StockTradingSimulator
+
+START = datetime(2024, 10, 17, 9, 0, 4)
+COMBINATIONS = list(product([1.0, 1.5], [5], [30, 65], [78], [0.007], [300], [5], [2], [5], [3, 2002]))
+
+# Random walk quotes with short one-sided order book runs, so the trend
+# counters fire, and a share of rows that repeat the previous quote, so the
+# delta trend update has tickers to skip.
+def synthetic_tape(seed=0, n_tickers=12, n_ticks=300, hold=0.5):
+    rng = np.random.default_rng(seed)
+    ticker_ids = list(range(1000, 1000 + n_tickers))
+    steps = rng.choice([-1, 0, 1], size=(n_ticks, n_tickers)) * rng.uniform(0.0002, 0.0008, (n_ticks, n_tickers))
+    bid = (rng.uniform(2000, 14000, n_tickers) * np.cumprod(1 + steps, axis=0)).round(1)
+    ask = (bid * (1 + rng.choice([0.0001, 0.0002], size=(n_ticks, n_tickers)))).round(1)
+    ask_qty = np.empty((n_ticks, n_tickers))
+    bid_qty = np.empty((n_ticks, n_tickers))
+    ask_qty[0] = rng.integers(10000, 100000, n_tickers)
+    bid_qty[0] = rng.integers(10000, 100000, n_tickers)
+    mode = np.zeros(n_tickers, int)
+    left = np.zeros(n_tickers, int)
+    for row in range(1, n_ticks):
+        start = (left == 0) & (rng.random(n_tickers) < 0.05)
+        mode[start] = rng.choice([1, 2], start.sum())
+        left[start] = rng.integers(3, 9, start.sum())
+        ask_qty[row] = np.round(ask_qty[row - 1] * np.where(mode == 1, 1.018, np.where(mode == 2, 0.982, 1 + rng.normal(0, 0.004, n_tickers))))
+        bid_qty[row] = np.round(bid_qty[row - 1] * np.where(mode == 1, 0.982, np.where(mode == 2, 1.018, 1 + rng.normal(0, 0.004, n_tickers))))
+        left = np.maximum(left - 1, 0)
+        mode[left == 0] = 0
+    volume = np.cumsum(rng.integers(0, 200, (n_ticks, n_tickers)), axis=0) + 70000
+    held = rng.random((n_ticks, n_tickers)) < hold
+    held[0] = False
+    source = np.maximum.accumulate(np.where(held, -1, np.arange(n_ticks)[:, None]), axis=0)
+    rows = []
+    for row in range(n_ticks):
+        timestamp = to_epoch(START + timedelta(seconds=8 * row))
+        for col, ticker_id in enumerate(ticker_ids):
+            src = source[row, col]
+            rows.append([timestamp, ticker_id, bid[src, col], volume[src, col], ask_qty[src, col], bid_qty[src, col], ask[src, col], bid[src, col]])
+    return build_day_tape(rows, ticker_ids)
+
+# monitor_and_trade without the price index: every signalled ticker is traded
+def step(sim, tick, current_time):
+    sim.set_metrics(tick, current_time)
+    sim.update_trade_tickers()
+    if sim.stop_engine == 'batched':
+        sim.evaluate_stops()
+    for cnt, param in sim.params.items():
+        if param['stop']:
+            continue
+        if sim.stop_engine == 'batched':
+            sim.settle_stops(cnt)
+        else:
+            for pos in param['pfl'].scan():
+                sim.apply_stop_loss_and_take_profit(cnt, pos)
+        long_list, short_list = sim.get_trade_tickers(cnt)
+        if current_time.hour >= 10:
+            continue
+        for ticker_id in long_list:
+            sim.buy_stock(cnt, ticker_id, param['min_trade_qty'], sim.get_current_long_price(ticker_id))
+        for ticker_id in short_list:
+            sim.short_sell_stock(cnt, ticker_id, param['min_trade_qty'], sim.get_current_short_price(ticker_id))
+    sim.show_estimated_profit()
+
+def replay(tape, stop_engine='scalar', resume_at=None):
+    features = build_features(tape)
+    sim = StockTradingSimulator(COMBINATIONS, False, tape.ticker_ids.tolist(), stop_engine)
+    for cnt in sim.params:
+        sim.init_trade_tickers(cnt)
+    trace = []
+    for row in range(tape.n_ticks):
+        if row == resume_at:
+            # same as restore_shard: the snapshot drops the per-tick caches
+            sim = pickle.loads(pickle.dumps(sim, pickle.HIGHEST_PROTOCOL))
+            sim.set_metrics(tick_at(features, row - 1, blank_tick(features)), sim.current_time)
+        step(sim, feature_tick(features, row), START + timedelta(seconds=8 * row))
+        trace.append(([(param['balance'], param['real_profit']) for param in sim.params.values()],
+                      [[field.tolist() for field in group.base.fields.values()] for group in sim.trend_groups.values()]))
+    results = [(param['balance'], param['real_profit'], param['real_max_profit']['value'], param['stop'], param['transaction_counts'])
+               for param in sim.params.values()]
+    return results, trace
+
+def n_trades(results):
+    return sum(sum(result[4].values()) for result in results)
+
+def test_batched_stops_match_scalar():
+    tape = synthetic_tape()
+    scalar = replay(tape, 'scalar')
+    assert n_trades(scalar[0]) > 0
+    assert replay(tape, 'batched') == scalar
+
+def test_delta_trend_update_matches_full_update(monkeypatch):
+    tape = synthetic_tape(1)
+    delta = replay(tape)
+    assert n_trades(delta[0]) > 0
+    monkeypatch.setattr(StockTradingSimulator, 'changed_tickers', lambda self: None)
+    assert replay(tape) == delta
+
+def test_resumed_run_matches_straight_run():
+    tape = synthetic_tape(2)
+    for stop_engine in ['scalar', 'batched']:
+        straight = replay(tape, stop_engine)
+        assert n_trades(straight[0]) > 0
+        assert replay(tape, stop_engine, resume_at=120) == straight
@@ -0,0 +1,251 @@
+import numpy as np
+
+TREND_FIELDS = {
+    'last_high_total_ask_qty': -1,
+    'last_high_bid_price': -1,
+    'last_low_total_bid_qty': 1000000000,
+    'last_high_total_bid_qty': -1,
+    'last_low_ask_price': 1000000000,
+    'last_low_total_ask_qty': 1000000000,
+    'num_of_ask_qty_inc': 0,
+    'num_of_bid_qty_inc': 0
+}
+
+COUNTER_FIELDS = ['num_of_ask_qty_inc', 'num_of_bid_qty_inc']
+
+# tick columns update_trend reads, besides the present mask
+TREND_INPUTS = ['ask_quantity_total', 'bid_quantity_total', 'long', 'short', 'present']
+
+# fields cleared by get_trade_tickers once a ticker is handed out as a short / long trade
+SHORT_SIGNAL_RESET = ['last_high_total_ask_qty', 'last_high_bid_price', 'last_low_total_bid_qty', 'num_of_ask_qty_inc']
+LONG_SIGNAL_RESET = ['last_high_total_bid_qty', 'last_low_ask_price', 'last_low_total_ask_qty', 'num_of_bid_qty_inc']
+
+def update_trend(fields, ask_qty, bid_qty, ask_price, bid_price, mask, min_diff, max_diff, min_price_diff, max_price_diff):
+    high_ask_qty = fields['last_high_total_ask_qty']
+    low_bid_qty = fields['last_low_total_bid_qty']
+    low_ask_price = fields['last_low_ask_price']
+    high_bid_qty = fields['last_high_total_bid_qty']
+    low_ask_qty = fields['last_low_total_ask_qty']
+    high_bid_price = fields['last_high_bid_price']
+
+    ask_inc = (mask &
+               (ask_qty > high_ask_qty * (1 + min_diff)) &
+               (bid_qty < low_bid_qty * (1 - min_diff)) &
+               (ask_price < low_ask_price * (1 - min_price_diff)))
+    ask_reset = (mask & ~ask_inc &
+                 ((ask_qty < high_ask_qty * (1 - min_diff)) |
+                  (ask_qty > high_ask_qty * (1 + max_diff)) |
+                  (bid_qty > low_bid_qty * (1 + min_diff)) |
+                  (bid_qty < low_bid_qty * (1 - max_diff)) |
+                  (ask_price > low_ask_price * (1 + min_price_diff)) |
+                  (ask_price < low_ask_price * (1 - max_price_diff))))
+
+    bid_inc = (mask &
+               (bid_qty > high_bid_qty * (1 + min_diff)) &
+               (ask_qty < low_ask_qty * (1 - min_diff)) &
+               (bid_price > high_bid_price * (1 + min_price_diff)))
+    bid_reset = (mask & ~bid_inc &
+                 ((bid_qty < high_bid_qty * (1 - min_diff)) |
+                  (bid_qty > high_bid_qty * (1 + max_diff)) |
+                  (ask_qty > low_ask_qty * (1 + min_diff)) |
+                  (ask_qty < low_ask_qty * (1 - max_diff)) |
+                  (bid_price < high_bid_price * (1 - min_diff)) |
+                  (bid_price > high_bid_price * (1 + max_price_diff))))
+
+    high_ask_qty[ask_inc] = ask_qty[ask_inc]
+    low_ask_price[ask_inc] = ask_price[ask_inc]
+    low_bid_qty[ask_inc] = bid_qty[ask_inc]
+    fields['num_of_ask_qty_inc'][ask_inc] += 1
+    for name in ['last_high_total_ask_qty', 'last_low_ask_price', 'last_low_total_bid_qty', 'num_of_ask_qty_inc']:
+        fields[name][ask_reset] = TREND_FIELDS[name]
+
+    high_bid_qty[bid_inc] = bid_qty[bid_inc]
+    high_bid_price[bid_inc] = bid_price[bid_inc]
+    low_ask_qty[bid_inc] = ask_qty[bid_inc]
+    fields['num_of_bid_qty_inc'][bid_inc] += 1
+    for name in ['last_high_total_bid_qty', 'last_high_bid_price', 'last_low_total_ask_qty', 'num_of_bid_qty_inc']:
+        fields[name][bid_reset] = TREND_FIELDS[name]
+
+# A row whose inputs are the same as last tick and whose state did not move in
+# the last update is a fixed point of update_trend, so update() only revisits
+# rows with changed inputs or a state change last tick. The same goes for the
+# hit sets behind hits(): they are kept up to date from the rows that moved.
+class TrendState:
+    def __init__(self, n_tickers):
+        self.fields = {
+            name: np.full(n_tickers, initial, dtype=np.int64 if name in COUNTER_FIELDS else np.float64)
+            for name, initial in TREND_FIELDS.items()
+        }
+        self.touched = np.ones(n_tickers, dtype=bool)
+        self.hit_sets = {}
+        self.hit_cache = {}
+
+    # cached hits are keyed by id(mask), which means nothing after unpickling
+    def __getstate__(self):
+        return {'fields': self.fields, 'touched': self.touched, 'hit_sets': self.hit_sets, 'hit_cache': {}}
+
+    def update(self, ask_qty, bid_qty, ask_price, bid_price, mask, min_diff, max_diff, min_price_diff, max_price_diff, changed=None,
+               active=None):
+        self.hit_cache.clear()
+        rows = np.ones(len(self.touched), dtype=bool) if changed is None else changed | self.touched
+        if active is not None:
+            rows &= active
+        cols = np.flatnonzero(rows)
+        fields = {name: field[cols] for name, field in self.fields.items()}
+        update_trend(fields, ask_qty[cols], bid_qty[cols], ask_price[cols], bid_price[cols], mask[cols],
+                     min_diff, max_diff, min_price_diff, max_price_diff)
+
+        moved = np.zeros(len(cols), dtype=bool)
+        for name, field in fields.items():
+            moved |= field != self.fields[name][cols]
+            self.fields[name][cols] = field
+        cols = cols[moved]
+        self.touched[:] = False
+        self.touched[cols] = True
+        self.track(cols)
+
+    def track(self, cols):
+        for (name, value), hit_set in self.hit_sets.items():
+            hit = self.fields[name][cols] == value
+            hit_set.difference_update(cols[~hit].tolist())
+            hit_set.update(cols[hit].tolist())
+
+    def count(self, name, col):
+        return self.fields[name][col]
+
+    def hits(self, name, value, mask):
+        key = (name, value, id(mask))
+        if key not in self.hit_cache:
+            if (name, value) not in self.hit_sets:
+                self.hit_sets[(name, value)] = set(np.flatnonzero(self.fields[name] == value).tolist())
+            self.hit_cache[key] = [col for col in sorted(self.hit_sets[(name, value)]) if mask[col]]
+        return self.hit_cache[key]
+
+    def reset(self, col, names):
+        self.hit_cache.clear()
+        for name in names:
+            self.fields[name][col] = TREND_FIELDS[name]
+        self.touched[col] = True
+        self.track(np.array([col]))
+
+# Combinations with the same thresholds see identical trend updates; they only
+# diverge where get_trade_tickers resets a ticker for one of them. A group keeps
+# one shared state plus a stacked table of copy-on-write rows, one per
+# (combination, ticker) that currently differs from the shared row.
+class TrendGroup:
+    def __init__(self, n_tickers):
+        self.base = TrendState(n_tickers)
+        self.forks = TrendState(0)
+        self.fork_cols = np.empty(0, dtype=np.int64)
+        self.fork_alive = np.empty(0, dtype=bool)
+        self.fork_owners = []
+        self.n_forks = 0
+        self.fork_hit_cache = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['fork_hit_cache'] = {}
+        return state
+
+    def update(self, ask_qty, bid_qty, ask_price, bid_price, mask, min_diff, max_diff, min_price_diff, max_price_diff, changed=None,
+               active=None):
+        self.base.update(ask_qty, bid_qty, ask_price, bid_price, mask, min_diff, max_diff, min_price_diff, max_price_diff, changed,
+                         active)
+        if self.n_forks == 0:
+            return
+
+        n = self.n_forks
+        cols = self.fork_cols[:n]
+        fields = {name: field[:n] for name, field in self.forks.fields.items()}
+        fork_mask = mask[cols] if active is None else mask[cols] & active[cols]
+        update_trend(fields, ask_qty[cols], bid_qty[cols], ask_price[cols], bid_price[cols], fork_mask,
+                     min_diff, max_diff, min_price_diff, max_price_diff)
+        self.merge()
+
+    # forked columns at `value`, grouped by the fork that owns them
+    def fork_hits(self, name, value):
+        key = (name, value)
+        if key not in self.fork_hit_cache:
+            n = self.n_forks
+            rows = np.flatnonzero((self.forks.fields[name][:n] == value) & self.fork_alive[:n])
+            by_owner = {}
+            for row, col in zip(rows.tolist(), self.fork_cols[rows].tolist()):
+                by_owner.setdefault(id(self.fork_owners[row]), []).append(col)
+            self.fork_hit_cache[key] = by_owner
+        return self.fork_hit_cache[key]
+
+    def merge(self):
+        self.fork_hit_cache.clear()
+        n = self.n_forks
+        cols = self.fork_cols[:n]
+        same = self.fork_alive[:n].copy()
+        for name, field in self.forks.fields.items():
+            same &= field[:n] == self.base.fields[name][cols]
+
+        rows = np.flatnonzero(same)
+        for row, col in zip(rows.tolist(), cols[rows].tolist()):
+            del self.fork_owners[row].pos[col]
+        self.fork_alive[rows] = False
+
+        if not self.fork_alive[:n].any():
+            self.fork_owners = []
+            self.n_forks = 0
+        elif 2 * np.count_nonzero(self.fork_alive[:n]) < n:
+            self.compact()
+
+    def compact(self):
+        keep = np.flatnonzero(self.fork_alive[:self.n_forks])
+        for name, field in self.forks.fields.items():
+            field[:len(keep)] = field[keep]
+        self.fork_cols[:len(keep)] = self.fork_cols[keep]
+        self.fork_alive[:len(keep)] = True
+        self.fork_owners = [self.fork_owners[row] for row in keep.tolist()]
+        self.n_forks = len(keep)
+        for row, (owner, col) in enumerate(zip(self.fork_owners, self.fork_cols[:self.n_forks].tolist())):
+            owner.pos[col] = row
+
+    def fork(self, owner, col):
+        self.fork_hit_cache.clear()
+        row = self.n_forks
+        if row == len(self.fork_cols):
+            capacity = max(64, 2 * row)
+            for name, field in self.forks.fields.items():
+                self.forks.fields[name] = np.resize(field, capacity)
+            self.fork_cols = np.resize(self.fork_cols, capacity)
+            self.fork_alive = np.resize(self.fork_alive, capacity)
+
+        for name, field in self.forks.fields.items():
+            field[row] = self.base.fields[name][col]
+        self.fork_cols[row] = col
+        self.fork_alive[row] = True
+        self.fork_owners.append(owner)
+        self.n_forks += 1
+        owner.pos[col] = row
+        return row
+
+class TrendFork:
+    def __init__(self, group):
+        self.group = group
+        self.pos = {}
+
+    def count(self, name, col):
+        row = self.pos.get(col)
+        if row is None:
+            return self.group.base.fields[name][col]
+        return self.group.forks.fields[name][row]
+
+    def hits(self, name, value, mask):
+        cols = self.group.base.hits(name, value, mask)
+        if not self.pos:
+            return cols
+        cols = [col for col in cols if col not in self.pos]
+        own = [col for col in self.group.fork_hits(name, value).get(id(self), []) if mask[col]]
+        return sorted(cols + own) if own else cols
+
+    def reset(self, col, names):
+        self.group.fork_hit_cache.clear()
+        row = self.pos.get(col)
+        if row is None:
+            row = self.group.fork(self, col)
+        for name in names:
+            self.group.forks.fields[name][row] = TREND_FIELDS[name]